@@ -1,15 +1,36 @@
 # https://github.com/xinntao/BasicSR
 # flake8: noqa
-from .archs import *
-from .data import *
-from .losses import *
-from .metrics import *
-from .models import *
+import importlib
+
+# Subpackage of every public name. Subpackages and names are imported on first attribute
+# access (PEP 562) instead of at import time, so that e.g. `basicsr.archs.ddcolor_arch_utils`
+# does not load the training stack, and unknown names fail without importing anything.
+_SUBMODULES = ['archs', 'data', 'losses', 'metrics', 'models', 'train', 'utils']
+_LAZY_ATTRS = {
+    'build_network': 'archs',
+    **dict.fromkeys(['build_dataloader', 'build_dataset'], 'data'),
+    **dict.fromkeys(['CharbonnierLoss', 'GANLoss', 'L1Loss', 'MSELoss', 'PerceptualLoss', 'WeightedTVLoss',
+                     'g_path_regularize', 'gradient_penalty_loss', 'r1_penalty'], 'losses'),
+    **dict.fromkeys(['calculate_cf', 'calculate_psnr', 'calculate_ssim'], 'metrics'),
+    'build_model': 'models',
+    **dict.fromkeys(['create_train_val_dataloader', 'init_tb_loggers', 'load_resume_state', 'train_pipeline'],
+                    'train'),
+    **dict.fromkeys(['AvgTimer', 'DiffJPEG', 'FileClient', 'MessageLogger', 'USMSharp', 'check_resume', 'crop_border',
+                     'get_env_info', 'get_root_logger', 'get_time_str', 'imfrombytes', 'img2tensor', 'imwrite',
+                     'init_tb_logger', 'init_wandb_logger', 'make_exp_dirs', 'mkdir_and_rename', 'scandir',
+                     'set_random_seed', 'sizeof_fmt', 'tensor2img', 'usm_sharp'], 'utils'),
+}
 # from .ops import *
 # from .test import *
-from .train import *
-from .utils import *
 try:
     from .version import __gitsha__, __version__
 except:
     pass
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if name in _LAZY_ATTRS:
+        return getattr(importlib.import_module(f'.{_LAZY_ATTRS[name]}', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
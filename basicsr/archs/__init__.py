@@ -1,4 +1,3 @@
-import importlib
 from copy import deepcopy
 from os import path as osp
 
@@ -12,8 +11,8 @@ __all__ = ['build_network']
 # '_arch.py'
 arch_folder = osp.dirname(osp.abspath(__file__))
 arch_filenames = [osp.splitext(osp.basename(v))[0] for v in scandir(arch_folder) if v.endswith('_arch.py')]
-# import all the arch modules
-_arch_modules = [importlib.import_module(f'basicsr.archs.{file_name}') for file_name in arch_filenames]
+# import the arch modules on the first registry lookup
+ARCH_REGISTRY.register_lazy_modules([f'basicsr.archs.{file_name}' for file_name in arch_filenames])
 
 
 def build_network(opt):
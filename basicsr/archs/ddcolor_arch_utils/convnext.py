@@ -9,7 +9,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from timm.models.layers import trunc_normal_, DropPath
 
 class Block(nn.Module):
     r""" ConvNeXt Block. There are two equivalent implementations:
@@ -31,7 +30,12 @@ class Block(nn.Module):
         self.pwconv2 = nn.Linear(4 * dim, dim)
         self.gamma = nn.Parameter(layer_scale_init_value * torch.ones((dim)), 
                                     requires_grad=True) if layer_scale_init_value > 0 else None
-        self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        if drop_path > 0.:
+            # timm is slow to import and only needed for stochastic depth in training
+            from timm.models.layers import DropPath
+            self.drop_path = DropPath(drop_path)
+        else:
+            self.drop_path = nn.Identity()
 
     def forward(self, x):
         input = x
@@ -81,7 +85,7 @@ class ConvNeXt(nn.Module):
             self.downsample_layers.append(downsample_layer)
 
         self.stages = nn.ModuleList() # 4 feature resolution stages, each consisting of multiple residual blocks
-        dp_rates=[x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))] 
+        dp_rates=[x.item() for x in torch.linspace(0, drop_path_rate, sum(depths), device='cpu')] 
         cur = 0
         for i in range(4):
             stage = nn.Sequential(
@@ -108,7 +112,7 @@ class ConvNeXt(nn.Module):
 
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv2d, nn.Linear)):
-            trunc_normal_(m.weight, std=.02)
+            nn.init.trunc_normal_(m.weight, std=.02)
             nn.init.constant_(m.bias, 0)
 
     def forward_features(self, x):
@@ -123,6 +127,21 @@ class ConvNeXt(nn.Module):
 
         return self.norm(x.mean([-2, -1])) # global average pooling, (N, C, H, W) -> (N, C)
 
+    def forward_multiscale(self, x, out_indices=(0, 1, 2, 3)):
+        """Return the ``norm{i}`` features of the stages in ``out_indices``, from shallow to deep.
+
+        Stages after the deepest requested one and the pooled classification norm are skipped,
+        and only the normalized features are kept, the raw stage outputs are dropped as soon as
+        the next stage consumed them.
+        """
+        features = []
+        for i in range(max(out_indices) + 1):
+            x = self.downsample_layers[i](x)
+            x = self.stages[i](x)
+            if i in out_indices:
+                features.append(getattr(self, f'norm{i}')(x))
+        return features
+
     def forward(self, x):
         x = self.forward_features(x)
         # x = self.head_cls(x)
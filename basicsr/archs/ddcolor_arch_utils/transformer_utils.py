@@ -2,6 +2,25 @@ from typing import Optional
 from torch import nn, Tensor
 from torch.nn import functional as F
 
+
+def sdpa_attention(attn: nn.MultiheadAttention, query, key, value):
+    """Batch-first forward of ``attn`` on ``F.scaled_dot_product_attention``.
+
+    ``query`` is (N, L, C), ``key`` and ``value`` are (N, S, C). The packed ``in_proj`` and
+    ``out_proj`` weights of ``attn`` are used as they are, so checkpoints load unchanged,
+    and unlike ``nn.MultiheadAttention`` no head-averaged attention weights are computed.
+    """
+    n, length, channels = query.shape
+    w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = attn.in_proj_bias.chunk(3)
+
+    def heads(x, weight, bias):
+        return F.linear(x, weight, bias).view(n, x.shape[1], attn.num_heads, -1).transpose(1, 2)
+
+    out = F.scaled_dot_product_attention(heads(query, w_q, b_q), heads(key, w_k, b_k), heads(value, w_v, b_v),
+                                         dropout_p=attn.dropout if attn.training else 0.0)
+    return attn.out_proj(out.transpose(1, 2).reshape(n, length, channels))
+
 class SelfAttentionLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dropout=0.0,
@@ -59,6 +78,13 @@ class SelfAttentionLayer(nn.Module):
         return self.forward_post(tgt, tgt_mask,
                                  tgt_key_padding_mask, query_pos)
 
+    def forward_batch_first(self, tgt, query_pos: Optional[Tensor] = None):
+        """Same as `forward` without masks, for batch-first (N, Q, C) queries."""
+        tgt2 = self.norm(tgt) if self.normalize_before else tgt
+        q = self.with_pos_embed(tgt2, query_pos)
+        tgt = tgt + self.dropout(sdpa_attention(self.self_attn, q, q, tgt2))
+        return tgt if self.normalize_before else self.norm(tgt)
+
 
 class CrossAttentionLayer(nn.Module):
 
@@ -122,6 +148,17 @@ class CrossAttentionLayer(nn.Module):
         return self.forward_post(tgt, memory, memory_mask,
                                  memory_key_padding_mask, pos, query_pos)
 
+    def forward_batch_first(self, tgt, memory, memory_pos, query_pos: Optional[Tensor] = None):
+        """Same as `forward` without masks, for batch-first (N, Q, C) queries and (N, HW, C) memory.
+
+        ``memory_pos`` is ``memory + pos``, which callers that attend to the same memory from
+        several layers compute once and share.
+        """
+        tgt2 = self.norm(tgt) if self.normalize_before else tgt
+        tgt2 = sdpa_attention(self.multihead_attn, self.with_pos_embed(tgt2, query_pos), memory_pos, memory)
+        tgt = tgt + self.dropout(tgt2)
+        return tgt if self.normalize_before else self.norm(tgt)
+
 
 class FFNLayer(nn.Module):
 
@@ -2,6 +2,8 @@ from enum import Enum
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.spectral_norm import SpectralNorm
+from torch.nn.utils.weight_norm import WeightNorm
 import collections
 
 
@@ -72,6 +74,42 @@ def icnr(x, scale=2, init=nn.init.kaiming_normal_):
     x.data.copy_(k)
 
 
+def remove_norm_hooks(module: nn.Module) -> nn.Module:
+    "Bake the `spectral_norm`/`weight_norm` reparametrizations of all submodules of `module` into static weights."
+    for m in module.modules():
+        for hook in list(m._forward_pre_hooks.values()):
+            if isinstance(hook, SpectralNorm):
+                nn.utils.remove_spectral_norm(m, hook.name)
+            elif isinstance(hook, WeightNorm):
+                nn.utils.remove_weight_norm(m, hook.name)
+    return module
+
+
+def bn_scale_shift(bn: nn.BatchNorm2d):
+    "Per-channel `scale` and `shift` such that `bn(x) == x * scale + shift` in eval mode."
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    return scale, bn.bias - bn.running_mean * scale
+
+
+@torch.no_grad()
+def fuse_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> None:
+    "Fold `bn` applied to the output of `conv` into the weight and bias of `conv`."
+    scale, shift = bn_scale_shift(bn)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+    conv.weight = nn.Parameter(conv.weight * scale.view(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(bias * scale + shift)
+
+
+@torch.no_grad()
+def fuse_bn_conv(bn: nn.BatchNorm2d, conv: nn.Conv2d) -> None:
+    "Fold `bn` applied to the input of the unpadded 1x1 `conv` into the weight and bias of `conv`."
+    assert conv.kernel_size == (1, 1) and conv.padding == (0, 0) and conv.groups == 1
+    scale, shift = bn_scale_shift(bn)
+    bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels)
+    conv.bias = nn.Parameter(bias + conv.weight.sum((2, 3)) @ shift)
+    conv.weight = nn.Parameter(conv.weight * scale.view(1, -1, 1, 1))
+
+
 def conv1d(ni: int, no: int, ks: int = 1, stride: int = 1, padding: int = 0, bias: bool = False):
     "Create and initialize a `nn.Conv1d` layer with spectral normalization."
     conv = nn.Conv1d(ni, no, ks, stride=stride, padding=padding, bias=bias)
@@ -201,8 +239,9 @@ class UnetBlockWide(nn.Module):
         self.conv = custom_conv_layer(ni, n_out, norm_type=norm_type, self_attention=self_attention, extra_bn=True)
         self.relu = nn.ReLU()
 
-    def forward(self, up_in):
-        s = self.hook.feature
+    def forward(self, up_in, s=None):
+        if s is None:
+            s = self.hook.feature
         up_out = self.shuf(up_in)
         cat_x = self.relu(torch.cat([up_out, self.bn(s)], dim=1))
         return self.conv(cat_x)
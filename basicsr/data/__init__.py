@@ -1,4 +1,3 @@
-import importlib
 import numpy as np
 import random
 import torch
@@ -18,8 +17,8 @@ __all__ = ['build_dataset', 'build_dataloader']
 # scan all the files under the data folder with '_dataset' in file names
 data_folder = osp.dirname(osp.abspath(__file__))
 dataset_filenames = [osp.splitext(osp.basename(v))[0] for v in scandir(data_folder) if v.endswith('_dataset.py')]
-# import all the dataset modules
-_dataset_modules = [importlib.import_module(f'basicsr.data.{file_name}') for file_name in dataset_filenames]
+# import the dataset modules on the first registry lookup
+DATASET_REGISTRY.register_lazy_modules([f'basicsr.data.{file_name}' for file_name in dataset_filenames])
 
 
 def build_dataset(dataset_opt):
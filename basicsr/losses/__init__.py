@@ -1,15 +1,23 @@
+import importlib
 from copy import deepcopy
 
 from basicsr.utils import get_root_logger
 from basicsr.utils.registry import LOSS_REGISTRY
-from .losses import (CharbonnierLoss, GANLoss, L1Loss, MSELoss, PerceptualLoss, WeightedTVLoss, g_path_regularize,
-                     gradient_penalty_loss, r1_penalty)
 
 __all__ = [
     'L1Loss', 'MSELoss', 'CharbonnierLoss', 'WeightedTVLoss', 'PerceptualLoss', 'GANLoss', 'gradient_penalty_loss',
     'r1_penalty', 'g_path_regularize'
 ]
 
+# losses.py imports torchvision for the perceptual loss, import it on first use
+LOSS_REGISTRY.register_lazy_modules(['basicsr.losses.losses'])
+
+
+def __getattr__(name):
+    if name in __all__:
+        return getattr(importlib.import_module('.losses', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 def build_loss(opt):
     """Build loss from options.
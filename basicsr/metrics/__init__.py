@@ -1,11 +1,20 @@
+import importlib
 from copy import deepcopy
 
 from basicsr.utils.registry import METRIC_REGISTRY
-from .psnr_ssim import calculate_psnr, calculate_ssim
-from .colorfulness import calculate_cf
 
 __all__ = ['calculate_psnr', 'calculate_ssim', 'calculate_cf']
 
+# metric modules are imported on first use
+_METRIC_MODULES = {'calculate_psnr': 'psnr_ssim', 'calculate_ssim': 'psnr_ssim', 'calculate_cf': 'colorfulness'}
+METRIC_REGISTRY.register_lazy_modules([f'basicsr.metrics.{name}' for name in sorted(set(_METRIC_MODULES.values()))])
+
+
+def __getattr__(name):
+    if name in _METRIC_MODULES:
+        return getattr(importlib.import_module(f'.{_METRIC_MODULES[name]}', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 def calculate_metric(data, opt):
     """Calculate metric from data and options.
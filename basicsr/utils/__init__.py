@@ -1,9 +1,18 @@
-from .diffjpeg import DiffJPEG
-from .file_client import FileClient
-from .img_process_util import USMSharp, usm_sharp
-from .img_util import crop_border, imfrombytes, img2tensor, imwrite, tensor2img
-from .logger import AvgTimer, MessageLogger, get_env_info, get_root_logger, init_tb_logger, init_wandb_logger
-from .misc import check_resume, get_time_str, make_exp_dirs, mkdir_and_rename, scandir, set_random_seed, sizeof_fmt
+import importlib
+
+# Submodule of every public name. They are imported on first access (PEP 562), so
+# importing e.g. the registry does not pull in torchvision through img_util.
+_LAZY_ATTRS = {
+    'DiffJPEG': 'diffjpeg',
+    'FileClient': 'file_client',
+    'USMSharp': 'img_process_util',
+    'usm_sharp': 'img_process_util',
+    **dict.fromkeys(['crop_border', 'imfrombytes', 'img2tensor', 'imwrite', 'tensor2img'], 'img_util'),
+    **dict.fromkeys(['AvgTimer', 'MessageLogger', 'get_env_info', 'get_root_logger', 'init_tb_logger',
+                     'init_wandb_logger'], 'logger'),
+    **dict.fromkeys(['check_resume', 'get_time_str', 'make_exp_dirs', 'mkdir_and_rename', 'scandir', 'set_random_seed',
+                     'sizeof_fmt'], 'misc'),
+}
 
 __all__ = [
     # file_client.py
@@ -35,3 +44,9 @@ __all__ = [
     'USMSharp',
     'usm_sharp'
 ]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        return getattr(importlib.import_module(f'.{_LAZY_ATTRS[name]}', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,4 +1,5 @@
 # Modified from: https://github.com/facebookresearch/fvcore/blob/master/fvcore/common/registry.py  # noqa: E501
+import importlib
 
 
 class Registry():
@@ -25,15 +26,40 @@ class Registry():
     .. code-block:: python
 
         BACKBONE_REGISTRY.register(MyBackbone)
+
+    Modules that register objects can be added with ``register_lazy_modules``, they are
+    only imported on the first lookup. ``package`` is the package that adds them, it is
+    imported on the first lookup as well.
     """
 
-    def __init__(self, name):
+    def __init__(self, name, package=None):
         """
         Args:
             name (str): the name of this registry
+            package (str): the package whose modules register in this registry
         """
         self._name = name
         self._obj_map = {}
+        self._package = package
+        self._lazy_modules = []
+
+    def register_lazy_modules(self, module_names):
+        """
+        Import the given modules, which register objects in this registry, on the
+        first lookup instead of at import time.
+        """
+        self._lazy_modules.extend(module_names)
+
+    def _import_lazy_modules(self):
+        if self._package is not None:
+            importlib.import_module(self._package)
+        # A module stays listed until it imported, so a failed import is raised again on the
+        # next lookup instead of surfacing as a missing name
+        while self._lazy_modules:
+            module_name = self._lazy_modules[0]
+            importlib.import_module(module_name)
+            if module_name in self._lazy_modules:
+                self._lazy_modules.remove(module_name)
 
     def _do_register(self, name, obj):
         assert (name not in self._obj_map), (f"An object named '{name}' was already registered "
@@ -61,22 +87,28 @@ class Registry():
 
     def get(self, name):
         ret = self._obj_map.get(name)
+        if ret is None:
+            self._import_lazy_modules()
+            ret = self._obj_map.get(name)
         if ret is None:
             raise KeyError(f"No object named '{name}' found in '{self._name}' registry!")
         return ret
 
     def __contains__(self, name):
+        self._import_lazy_modules()
         return name in self._obj_map
 
     def __iter__(self):
+        self._import_lazy_modules()
         return iter(self._obj_map.items())
 
     def keys(self):
+        self._import_lazy_modules()
         return self._obj_map.keys()
 
 
-DATASET_REGISTRY = Registry('dataset')
-ARCH_REGISTRY = Registry('arch')
-MODEL_REGISTRY = Registry('model')
-LOSS_REGISTRY = Registry('loss')
-METRIC_REGISTRY = Registry('metric')
+DATASET_REGISTRY = Registry('dataset', 'basicsr.data')
+ARCH_REGISTRY = Registry('arch', 'basicsr.archs')
+MODEL_REGISTRY = Registry('model', 'basicsr.models')
+LOSS_REGISTRY = Registry('loss', 'basicsr.losses')
+METRIC_REGISTRY = Registry('metric', 'basicsr.metrics')
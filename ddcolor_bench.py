@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import subprocess
+
+# Training-only dependencies that must stay out of the inference import graph
+HEAVY_MODULES = ['skimage', 'scipy', 'timm', 'torchvision', 'tensorboard', 'basicsr.train', 'basicsr.data']
+
+
+def synthetic_page(height=1600, width=1120, seed=0):
+    """A reproducible manga-like gray page: panel borders, line art and a screentone area."""
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width), 255, np.uint8)
+    tone = (np.add.outer(np.arange(height) % 6, np.arange(width) % 6) < 3).astype(np.uint8) * 90 + 140
+    y0, x0 = height // 2, width // 3
+    page[y0:y0 + height // 4, x0:x0 + width // 2] = tone[y0:y0 + height // 4, x0:x0 + width // 2]
+    for _ in range(400):
+        pt1 = tuple(int(v) for v in rng.integers(0, (width, height)))
+        pt2 = tuple(int(v) for v in rng.integers(0, (width, height)))
+        cv2.line(page, pt1, pt2, int(rng.integers(0, 80)), int(rng.integers(1, 4)), cv2.LINE_AA)
+    for top in range(0, height, height // 3):
+        cv2.rectangle(page, (20, top + 20), (width - 20, top + height // 3 - 20), 0, 5)
+    return cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
+
+
+def load_pages(source, num_pages):
+    import cv2
+    from ddcolor_infer import IMAGE_SUFFIXES
+
+    if source == 'synthetic':
+        return [synthetic_page(seed=seed) for seed in range(num_pages)]
+    names = sorted(name for name in os.listdir(source) if name.lower().endswith(IMAGE_SUFFIXES))
+    pages = [cv2.imread(os.path.join(source, name)) for name in names]
+    return [page for page in pages if page is not None][:num_pages]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_config(config):
+    """Benchmark one configuration in this process and return its result dict."""
+    import cv2
+    import numpy as np
+    import torch
+    from ddcolor_infer import ImageColorizationPipeline
+
+    torch.set_num_threads(config['threads'])
+    cv2.setNumThreads(config['threads'])
+    pages = load_pages(config['source'], config['num_pages'])
+    assert len(pages) > 0, f"{config['source']} 中没有图片"
+
+    start = time.perf_counter()
+    colorizer = ImageColorizationPipeline(config['model_path'], input_size=config['input_size'],
+                                          model_size=config['model_size'], precision=config['precision'])
+    load_time = time.perf_counter() - start
+
+    batch_size = config['batch_size']
+    batches = [pages[i:i + batch_size] for i in range(0, len(pages), batch_size)]
+    colorizer.process_batch(batches[0])  # warm up
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(config['iterations']):
+        for batch in batches:
+            batch_start = time.perf_counter()
+            colorizer.process_batch(batch)
+            latencies.extend([(time.perf_counter() - batch_start) * 1000] * len(batch))
+    elapsed = time.perf_counter() - start
+
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return dict(config, precision_used=colorizer.precision, images_per_sec=len(latencies) / elapsed,
+                p50_ms=p50, p95_ms=p95, load_s=load_time, peak_rss_mb=peak_rss_mb(), torch=torch.__version__)
+
+
+def check_lab_parity(pages, tolerance=1):
+    """Compare the gray-level table path of the colour conversions with the OpenCV float path.
+
+    L from the table must match the float ``COLOR_BGR2Lab`` L, and the banded merge back
+    to BGR must stay within ``tolerance`` levels of converting the whole page in float.
+    """
+    import cv2
+    import numpy as np
+    from ddcolor_infer import gray_plane, gray_to_l, merge_lab
+
+    rng = np.random.default_rng(0)
+    worst = 0
+    for i, page in enumerate(pages):
+        page = cv2.cvtColor(cv2.cvtColor(page, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+        height, width = page.shape[:2]
+        ab = cv2.resize(rng.uniform(-60, 60, (32, 32, 2)).astype(np.float32), (width, height))
+
+        ref_l = cv2.cvtColor((page / 255.0).astype(np.float32), cv2.COLOR_BGR2Lab)[:, :, :1]
+        ref_bgr = (cv2.cvtColor(np.concatenate((ref_l, ab), axis=-1), cv2.COLOR_LAB2BGR) * 255.0).round()
+        l = gray_to_l(gray_plane(page))
+        l_error = np.abs(l - ref_l).max()
+        bgr_error = int(np.abs(merge_lab(l, ab).astype(np.int32) - ref_bgr.astype(np.uint8)).max())
+        worst = max(worst, bgr_error)
+        print(f'页面 {i}：L 最大误差 {l_error:.2e}，BGR 最大误差 {bgr_error} 级')
+    print(f"颜色转换一致性：{'通过' if worst <= tolerance else '失败'}（最大误差 {worst} 级，允许 {tolerance} 级）")
+    return worst <= tolerance
+
+
+def import_time(statement, repeat=3):
+    """Best wall time of ``statement`` in fresh interpreters and the modules it loaded."""
+    code = ('import sys, time; start = time.perf_counter(); ' + statement +
+            '; print(time.perf_counter() - start); print(",".join(sys.modules))')
+    best, modules = None, []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, encoding='utf-8', check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, loaded = proc.stdout.splitlines()[-2:]
+        if best is None or float(seconds) < best:
+            best, modules = float(seconds), loaded.split(',')
+    return best, modules
+
+
+def check_import_time(budget):
+    """Check that importing the inference entry point costs at most ``budget`` seconds more
+    than importing torch, cv2 and numpy themselves, and loads no training-only packages."""
+    baseline, _ = import_time('import torch, cv2, numpy')
+    seconds, modules = import_time('import ddcolor_infer')
+    heavy = [name for name in HEAVY_MODULES if name in modules]
+    overhead = seconds - baseline
+    print(f'导入 torch/cv2/numpy：{baseline:.2f} 秒，导入 ddcolor_infer：{seconds:.2f} 秒，'
+          f'额外耗时 {overhead:.2f} 秒（预算 {budget:.2f} 秒）')
+    if heavy:
+        print(f"推理程序导入了训练依赖：{', '.join(heavy)}")
+    return overhead <= budget and not heavy
+
+
+def run_subprocess(config):
+    # A fresh interpreter per configuration keeps peak RSS and thread pools independent
+    cmd = [sys.executable, os.path.abspath(__file__), '--config', json.dumps(config)]
+    proc = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+    lines = [line for line in proc.stdout.splitlines() if line.startswith('{')]
+    if proc.returncode != 0 or not lines:
+        return dict(config, error=(proc.stderr.strip().splitlines() or ['未知错误'])[-1])
+    return json.loads(lines[-1])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DDColor 推理性能测试')
+    parser.add_argument('--model', action='append', default=[], metavar='大小=路径',
+                        help='要测试的模型，例如 tiny=model/tiny.pth 或 large=model/net_g.pth，可重复指定')
+    parser.add_argument('--input-sizes', type=int, nargs='+', default=[256, 384, 512], help='模型输入尺寸')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4], help='批大小')
+    parser.add_argument('--threads', type=int, nargs='+', default=[os.cpu_count()], help='推理线程数')
+    parser.add_argument('--precisions', nargs='+', default=['fp32'], choices=['fp32', 'bf16', 'int8'], help='推理精度')
+    parser.add_argument('--pages', default=None, help='真实漫画页面所在目录，不指定时只使用合成页面')
+    parser.add_argument('--num-pages', type=int, default=8, help='每组测试使用的页面数')
+    parser.add_argument('--iterations', type=int, default=2, help='每组测试重复处理全部页面的次数')
+    parser.add_argument('-o', '--output', default='bench.json', help='结果 JSON 文件')
+    parser.add_argument('--check-lab', action='store_true', help='检查查表颜色转换与 OpenCV 浮点转换的一致性，然后退出')
+    parser.add_argument('--check-import', action='store_true',
+                        help='检查推理程序的导入耗时不超过预算且不导入训练依赖，然后退出')
+    parser.add_argument('--import-budget', type=float, default=0.5, help='导入 ddcolor_infer 相比 torch 允许的额外耗时（秒）')
+    parser.add_argument('--config', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.config is not None:
+        print(json.dumps(run_config(json.loads(args.config))))
+        return
+    if args.check_lab:
+        pages = load_pages('synthetic', args.num_pages) + (load_pages(args.pages, args.num_pages) if args.pages else [])
+        sys.exit(0 if check_lab_parity(pages) else 1)
+    if args.check_import:
+        sys.exit(0 if check_import_time(args.import_budget) else 1)
+
+    assert args.model, '请用 --model 指定至少一个模型，例如 --model tiny=model/tiny.pth'
+    models = [spec.split('=', 1) for spec in args.model]
+    sources = ['synthetic'] + ([args.pages] if args.pages else [])
+    configs = [
+        dict(model_size=model_size, model_path=model_path, input_size=input_size, batch_size=batch_size,
+             threads=threads, precision=precision, source=source, num_pages=args.num_pages,
+             iterations=args.iterations)
+        for (model_size, model_path), input_size, batch_size, threads, precision, source in itertools.product(
+            models, args.input_sizes, args.batch_sizes, args.threads, args.precisions, sources)
+    ]
+
+    results = []
+    print(f"{'模型':<7}{'尺寸':>6}{'批':>4}{'线程':>6}{'精度':>6}  {'页面':<10}{'张/秒':>8}{'p50':>9}{'p95':>9}{'内存MB':>9}")
+    for config in configs:
+        result = run_subprocess(config)
+        results.append(result)
+        source = 'synthetic' if config['source'] == 'synthetic' else 'real'
+        row = (f"{config['model_size']:<9}{config['input_size']:>6}{config['batch_size']:>5}{config['threads']:>7}"
+               f"{config['precision']:>7}  {source:<10}")
+        if 'error' in result:
+            print(row + f"失败：{result['error']}")
+            continue
+        rss = f"{result['peak_rss_mb']:.0f}" if result['peak_rss_mb'] is not None else '-'
+        print(row + f"{result['images_per_sec']:>9.2f}{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}{rss:>10}")
+
+    machine = dict(platform=platform.platform(), processor=platform.processor(), cpu_count=os.cpu_count(),
+                   python=platform.python_version())
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(dict(machine=machine, created=time.strftime('%Y-%m-%d %H:%M:%S'), results=results), f,
+                  ensure_ascii=False, indent=2)
+    print(f'结果已写入：{args.output}')
+
+
+if __name__ == '__main__':
+    main()
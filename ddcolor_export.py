@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import argparse
+import torch
+
+from ddcolor_infer import ImageColorizationPipeline, FROZEN_SUFFIX, ONNX_SUFFIX, load_frozen_model
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def export_deploy_checkpoint(src_path, dst_path, param_key='params', dtype='fp32'):
+    """Write the inference weights of a training checkpoint to a compact deploy checkpoint.
+
+    Only ``param_key`` of the checkpoint is kept (training checkpoints often hold both
+    ``params`` and ``params_ema``), floating point tensors are stored as ``dtype`` and every
+    tensor gets its own contiguous storage. The result is a regular zip-format ``torch.save``
+    file whose tensor records are aligned, so ``torch.load(..., mmap=True)`` maps them
+    straight from the page cache without unpickling a copy into RAM.
+    """
+    checkpoint = torch.load(src_path, map_location='cpu', mmap=True, weights_only=True)
+    if param_key not in checkpoint and 'params' in checkpoint:
+        print(f'检查点中没有 {param_key}，使用 params')
+        param_key = 'params'
+    state_dict = checkpoint[param_key] if param_key in checkpoint else checkpoint
+
+    deploy_state_dict = {}
+    for key, tensor in state_dict.items():
+        if key.startswith('module.'):  # remove unnecessary 'module.'
+            key = key[7:]
+        if tensor.is_floating_point():
+            tensor = tensor.to(DTYPES[dtype])
+        deploy_state_dict[key] = tensor.contiguous().clone()
+
+    torch.save({'params': deploy_state_dict, 'deploy': {'dtype': dtype, 'param_key': param_key}}, dst_path)
+    return dst_path
+
+
+@torch.no_grad()
+def export_frozen_model(model_path, dst_path, input_size=256, model_size='large', max_batch_size=8):
+    """Trace, freeze and optimize the deploy-converted DDColor for a fixed ``input_size``.
+
+    Freezing inlines the weights as constants and folds them into the graph, so the
+    Hook/decoder Python dispatch and the per-layer parameter lookups disappear. The artifact is checked against eager mode for every batch size up to
+    ``max_batch_size`` and stores its ``input_size`` and batch-size range as metadata.
+    """
+    colorizer = ImageColorizationPipeline(model_path, input_size=input_size, model_size=model_size)
+    model = colorizer.model
+    example = torch.rand(1, 3, input_size, input_size)
+    frozen = torch.jit.freeze(torch.jit.trace(model, example, check_trace=False))
+
+    for batch_size in range(1, max_batch_size + 1):
+        x = torch.rand(batch_size, 3, input_size, input_size)
+        error = (frozen(x) - model(x)).abs().max().item()
+        assert error < 1e-3, f'批大小为 {batch_size} 时固化模型与原模型不一致，最大误差 {error}'
+
+    meta = dict(input_size=input_size, max_batch_size=max_batch_size, model_size=model_size)
+    torch.jit.save(frozen, dst_path, _extra_files={'ddcolor.json': json.dumps(meta)})
+    return dst_path
+
+
+@torch.no_grad()
+def compare_frozen_model(model_path, frozen_path, input_size=256, model_size='large', batch_size=1, runs=5):
+    """Print the per-image forward time of the eager and the frozen model."""
+    eager = ImageColorizationPipeline(model_path, input_size=input_size, model_size=model_size).model
+    frozen, _ = load_frozen_model(frozen_path)
+    x = torch.rand(batch_size, 3, input_size, input_size)
+    for name, model in (('原模型', eager), ('固化模型', frozen)):
+        model(x)  # warm up, the frozen graph is optimized on its first runs
+        model(x)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(x)
+        print(f'{name}：{(time.perf_counter() - start) / runs / batch_size * 1000:.1f} ms/张')
+
+
+@torch.no_grad()
+def export_onnx(model_path, dst_path, input_size=256, model_size='large', opset=17):
+    """Export the deploy-converted DDColor to ONNX with a dynamic batch dimension.
+
+    The encoder hands its multi-scale features to the decoder as explicit values, so the
+    graph has no side-effecting hook state and runs on any ONNX runtime.
+    """
+    colorizer = ImageColorizationPipeline(model_path, input_size=input_size, model_size=model_size)
+    torch.onnx.export(
+        colorizer.model,
+        torch.rand(1, 3, input_size, input_size),
+        dst_path,
+        input_names=['gray_rgb'],
+        output_names=['ab'],
+        dynamic_axes={'gray_rgb': {0: 'batch'}, 'ab': {0: 'batch'}},
+        opset_version=opset,
+        dynamo=False,
+    )
+    return dst_path
+
+
+@torch.no_grad()
+def compare_onnx_model(model_path, onnx_path, input_size=256, model_size='large', batch_size=4, runs=5):
+    """Check the ONNX Runtime backend against PyTorch and print the throughput of both."""
+    torch_colorizer = ImageColorizationPipeline(model_path, input_size=input_size, model_size=model_size)
+    onnx_colorizer = ImageColorizationPipeline(onnx_path, input_size=input_size, model_size=model_size)
+
+    x = torch.rand(batch_size, 3, input_size, input_size)
+    error = (torch_colorizer.infer([x]) - onnx_colorizer.infer([x])).abs().max().item()
+    print(f'ONNX Runtime 与 PyTorch 的 ab 最大误差：{error:.2e}')
+    assert error < 1e-3, 'ONNX 模型输出与 PyTorch 不一致'
+
+    for name, colorizer in (('PyTorch', torch_colorizer), ('ONNX Runtime', onnx_colorizer)):
+        colorizer.infer([x])
+        start = time.perf_counter()
+        for _ in range(runs):
+            colorizer.infer([x])
+        elapsed = time.perf_counter() - start
+        print(f'{name}：{runs * batch_size / elapsed:.2f} 张/秒')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DDColor 模型导出工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    deploy = subparsers.add_parser('deploy', help='导出只含推理权重、可内存映射加载的检查点')
+    deploy.add_argument('model_path', help='训练得到的 .pth 检查点')
+    deploy.add_argument('-o', '--output', default=None, help='输出路径，默认为 <原文件名>_deploy.pth')
+    deploy.add_argument('--param-key', default='params', help='使用检查点中的哪组权重，例如 params_ema')
+    deploy.add_argument('--dtype', default='fp32', choices=list(DTYPES), help='权重的存储精度')
+
+    jit = subparsers.add_parser('jit', help='导出固定输入尺寸的固化 TorchScript 模型（.pt）')
+    jit.add_argument('model_path', help='.pth 检查点')
+    jit.add_argument('-o', '--output', default=None, help=f'输出路径，默认为 <原文件名>_<输入尺寸>{FROZEN_SUFFIX}')
+    jit.add_argument('--input-size', type=int, default=256, help='模型输入尺寸')
+    jit.add_argument('--model-size', default='large', choices=['tiny', 'large'], help='模型大小')
+    jit.add_argument('--max-batch-size', type=int, default=8, help='校验过的最大批大小，推理时更大的批会被拆分')
+    jit.add_argument('--benchmark', action='store_true', help='导出后对比原模型与固化模型的速度')
+
+    onnx = subparsers.add_parser('onnx', help='导出 ONNX 模型，可用 onnxruntime 推理')
+    onnx.add_argument('model_path', help='.pth 检查点')
+    onnx.add_argument('-o', '--output', default=None, help=f'输出路径，默认为 <原文件名>_<输入尺寸>{ONNX_SUFFIX}')
+    onnx.add_argument('--input-size', type=int, default=256, help='模型输入尺寸')
+    onnx.add_argument('--model-size', default='large', choices=['tiny', 'large'], help='模型大小')
+    onnx.add_argument('--opset', type=int, default=17, help='ONNX opset 版本')
+    onnx.add_argument('--check', action='store_true', help='导出后校验与 PyTorch 的一致性并对比吞吐量')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == 'deploy':
+        output = args.output or os.path.splitext(args.model_path)[0] + '_deploy.pth'
+        export_deploy_checkpoint(args.model_path, output, param_key=args.param_key, dtype=args.dtype)
+        print(f'已导出：{output}（{os.path.getsize(output) / 1024 ** 2:.1f} MB）')
+    elif args.command == 'jit':
+        output = args.output or os.path.splitext(args.model_path)[0] + f'_{args.input_size}{FROZEN_SUFFIX}'
+        export_frozen_model(args.model_path, output, input_size=args.input_size, model_size=args.model_size,
+                            max_batch_size=args.max_batch_size)
+        print(f'已导出：{output}')
+        if args.benchmark:
+            compare_frozen_model(args.model_path, output, input_size=args.input_size, model_size=args.model_size)
+    elif args.command == 'onnx':
+        output = args.output or os.path.splitext(args.model_path)[0] + f'_{args.input_size}{ONNX_SUFFIX}'
+        export_onnx(args.model_path, output, input_size=args.input_size, model_size=args.model_size, opset=args.opset)
+        print(f'已导出：{output}')
+        if args.check:
+            compare_onnx_model(args.model_path, output, input_size=args.input_size, model_size=args.model_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,19 @@
 import os
-from skimage import color
+import csv
+import json
+import time
+import queue
+import shutil
+import sqlite3
+import hashlib
+import zipfile
+import functools
+import itertools
+import threading
+import contextlib
+import multiprocessing as mp
+from collections import Counter, deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import argparse
 import numpy as np
@@ -7,11 +21,12 @@ import torch.nn.functional as F
 from tqdm import tqdm
 import torch
 import torch.nn as nn
-from basicsr.archs.ddcolor_arch_utils.unet import Hook, CustomPixelShuffle_ICNR, UnetBlockWide, NormType, \
-    custom_conv_layer
+from basicsr.archs.ddcolor_arch_utils.unet import CustomPixelShuffle_ICNR, UnetBlockWide, NormType, \
+    custom_conv_layer, remove_norm_hooks, bn_scale_shift, fuse_conv_bn, fuse_bn_conv
 from basicsr.archs.ddcolor_arch_utils.convnext import ConvNeXt
 from basicsr.archs.ddcolor_arch_utils.transformer_utils import SelfAttentionLayer, CrossAttentionLayer, FFNLayer, MLP
 from basicsr.archs.ddcolor_arch_utils.position_encoding import PositionEmbeddingSine
+from basicsr.metrics.colorfulness import calculate_cf
 
 
 class DDColor(nn.Module):
@@ -33,11 +48,10 @@ class DDColor(nn.Module):
 
         self.encoder = ImageEncoder(encoder_name, ['norm0', 'norm1', 'norm2', 'norm3'])
         self.encoder.eval()
-        test_input = torch.randn(1, num_input_channels, *input_size)
-        self.encoder(test_input)
 
+        # Decoder widths come from the encoder config, no probe forward is needed to size them.
         self.decoder = DuelDecoder(
-            self.encoder.hooks,
+            self.encoder.feature_channels,
             nf=nf,
             last_norm=last_norm,
             num_queries=num_queries,
@@ -60,14 +74,49 @@ class DDColor(nn.Module):
     def denormalize(self, img):
         return img * self.std + self.mean
 
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        """Convert the eval-mode network into an equivalent one without normalization overhead.
+
+        Spectral/weight norm are baked into plain conv weights, so no parametrization hooks
+        recompute them on every forward. The BatchNorms of each ``UnetBlockWide`` are folded
+        into neighbouring layers: ``bn`` on the skip feature into the affine of the encoder
+        ``norm{i}`` it follows, the ``shuf`` BN into its conv, and the BN that ends ``conv``
+        (after its ReLU) into the 1x1 convs that consume the block output.
+        """
+        remove_norm_hooks(self)
+
+        blocks = list(self.decoder.layers)
+        norms = [getattr(self.encoder.arch, name) for name in self.encoder.hook_names][-2::-1]
+        input_proj = self.decoder.color_decoder.input_proj
+        consumers = [
+            [blocks[1].shuf.conv[0], input_proj[0]],
+            [blocks[2].shuf.conv[0], input_proj[1]],
+            [self.decoder.last_shuf.conv[0], input_proj[2]],
+        ]
+        for block, norm, convs in zip(blocks, norms, consumers):
+            scale, shift = bn_scale_shift(block.bn)
+            norm.weight = nn.Parameter(norm.weight * scale)
+            norm.bias = nn.Parameter(norm.bias * scale + shift)
+            block.bn = nn.Identity()
+
+            fuse_conv_bn(block.shuf.conv[0], block.shuf.conv[1])
+            block.shuf.conv[1] = nn.Identity()
+
+            for conv in convs:
+                fuse_bn_conv(block.conv[2], conv)
+            block.conv[2] = nn.Identity()
+        return self
+
     def forward(self, x):
         if x.shape[1] == 3:
             x = self.normalize(x)
 
-        self.encoder(x)
-        out_feat = self.decoder()
-        coarse_input = torch.cat([out_feat, x], dim=1)
-        out = self.refine_net(coarse_input)
+        out_feat = self.decoder(self.encoder(x))
+        # The final ab projection stays in fp32 under reduced precision autocast
+        with torch.autocast('cpu', enabled=False):
+            coarse_input = torch.cat([out_feat.float(), x.float()], dim=1)
+            out = self.refine_net(coarse_input)
 
         if self.do_normalize:
             out = self.denormalize(out)
@@ -80,28 +129,33 @@ class ImageEncoder(nn.Module):
 
         assert encoder_name == 'convnext-t' or encoder_name == 'convnext-l'
         if encoder_name == 'convnext-t':
-            self.arch = ConvNeXt(depths=[3, 3, 9, 3], dims=[96, 192, 384, 768])
+            dims = [96, 192, 384, 768]
+            self.arch = ConvNeXt(depths=[3, 3, 9, 3], dims=dims)
         elif encoder_name == 'convnext-l':
-            self.arch = ConvNeXt(depths=[3, 3, 27, 3], dims=[192, 384, 768, 1536])
+            dims = [192, 384, 768, 1536]
+            self.arch = ConvNeXt(depths=[3, 3, 27, 3], dims=dims)
         else:
             raise NotImplementedError
 
         self.encoder_name = encoder_name
         self.hook_names = hook_names
-        self.hooks = self.setup_hooks()
-
-    def setup_hooks(self):
-        hooks = [Hook(self.arch._modules[name]) for name in self.hook_names]
-        return hooks
+        self.out_indices = [int(name[len('norm'):]) for name in hook_names]
+        # Channels of the `norm{i}` outputs
+        self.feature_channels = [dims[i] for i in self.out_indices]
 
     def forward(self, x):
-        return self.arch(x)
+        """Return the multi-scale ``norm{i}`` features as explicit outputs, from shallow to deep.
+
+        No forward hooks keep the last batch's features alive between calls, and the
+        classification tail of ConvNeXt (pooling and final LayerNorm) is not run.
+        """
+        return self.arch.forward_multiscale(x, self.out_indices)
 
 
 class DuelDecoder(nn.Module):
     def __init__(
             self,
-            hooks,
+            feature_channels,
             nf=512,
             blur=True,
             last_norm='Weight',
@@ -111,7 +165,7 @@ class DuelDecoder(nn.Module):
             decoder_name='MultiScaleColorDecoder',
     ):
         super().__init__()
-        self.hooks = hooks
+        self.feature_channels = feature_channels
         self.nf = nf
         self.blur = blur
         self.last_norm = getattr(NormType, last_norm)
@@ -132,26 +186,29 @@ class DuelDecoder(nn.Module):
 
     def make_layers(self):
         decoder_layers = []
-        in_c = self.hooks[-1].feature.shape[1]
+        in_c = self.feature_channels[-1]
         out_c = self.nf
 
-        setup_hooks = self.hooks[-2::-1]
-        for layer_index, hook in enumerate(setup_hooks):
-            feature_c = hook.feature.shape[1]
-            if layer_index == len(setup_hooks) - 1:
+        skip_channels = self.feature_channels[-2::-1]
+        for layer_index, feature_c in enumerate(skip_channels):
+            if layer_index == len(skip_channels) - 1:
                 out_c = out_c // 2
             decoder_layers.append(
                 UnetBlockWide(
-                    in_c, feature_c, out_c, hook, blur=self.blur, self_attention=False, norm_type=NormType.Spectral))
+                    in_c, feature_c, out_c, None, blur=self.blur, self_attention=False, norm_type=NormType.Spectral))
             in_c = out_c
 
         return nn.Sequential(*decoder_layers)
 
-    def forward(self):
-        encode_feat = self.hooks[-1].feature
-        out0 = self.layers[0](encode_feat)
-        out1 = self.layers[1](out0)
-        out2 = self.layers[2](out1)
+    def forward(self, features):
+        # Skip features are passed explicitly instead of being read from hooks, so traced and
+        # exported graphs see them as ordinary data flow. Popping them releases each encoder
+        # feature as soon as its decoder block consumed it.
+        encode_feat = features.pop()
+        out0 = self.layers[0](encode_feat, features.pop())
+        del encode_feat
+        out1 = self.layers[1](out0, features.pop())
+        out2 = self.layers[2](out1, features.pop())
         out3 = self.last_shuf(out2)
 
         return self.color_decoder([out0, out1, out2], out3)
@@ -234,36 +291,31 @@ class MultiScaleColorDecoder(nn.Module):
         assert len(x) == self.num_feature_levels
 
         src, pos = self._get_src_and_pos(x)
+        # Every level is attended to by num_layers / num_scales layers, add its positional
+        # encoding to the keys once here instead of in each of them
+        src_pos = [feature + feature_pos for feature, feature_pos in zip(src, pos)]
+        del pos
 
-        bs = src[0].shape[1]
+        bs = src[0].shape[0]
 
-        # Prepare query embeddings (QxNxC)
-        query_embed = self.query_embed.weight.unsqueeze(1).repeat(1, bs, 1)
-        output = self.query_feat.weight.unsqueeze(1).repeat(1, bs, 1)
+        # Prepare query embeddings (NxQxC)
+        query_embed = self.query_embed.weight.unsqueeze(0).expand(bs, -1, -1)
+        output = self.query_feat.weight.unsqueeze(0).repeat(bs, 1, 1)
 
         for i in range(self.num_layers):
             level_index = i % self.num_feature_levels
             # attention: cross-attention first
-            output = self.transformer_cross_attention_layers[i](
-                output, src[level_index],
-                memory_mask=None,
-                memory_key_padding_mask=None,
-                pos=pos[level_index], query_pos=query_embed
-            )
-            output = self.transformer_self_attention_layers[i](
-                output, tgt_mask=None,
-                tgt_key_padding_mask=None,
-                query_pos=query_embed
-            )
+            output = self.transformer_cross_attention_layers[i].forward_batch_first(
+                output, src[level_index], src_pos[level_index], query_pos=query_embed)
+            output = self.transformer_self_attention_layers[i].forward_batch_first(output, query_pos=query_embed)
             # FFN
-            output = self.transformer_ffn_layers[i](
-                output
-            )
+            output = self.transformer_ffn_layers[i](output)
 
-        decoder_output = self.decoder_norm(output).transpose(0, 1)
+        decoder_output = self.decoder_norm(output)
         color_embed = self.color_embed(decoder_output)
 
-        out = torch.einsum("bqc,bchw->bqhw", color_embed, img_features)
+        with torch.autocast('cpu', enabled=False):
+            out = torch.einsum("bqc,bchw->bqhw", color_embed.float(), img_features.float())
 
         return out
 
@@ -279,67 +331,1174 @@ class MultiScaleColorDecoder(nn.Module):
     def _get_src_and_pos(self, x):
         src, pos = [], []
         for i, feature in enumerate(x):
-            pos.append(self.pe_layer(feature).flatten(2).permute(2, 0, 1))  # flatten NxCxHxW to HWxNxC
+            pos.append(self.pe_layer(feature).flatten(2).transpose(1, 2))  # flatten NxCxHxW to NxHWxC
             src.append(
-                (self.input_proj[i](feature).flatten(2) + self.level_embed.weight[i][None, :, None]).permute(2, 0, 1))
+                (self.input_proj[i](feature).flatten(2) + self.level_embed.weight[i][None, :, None]).transpose(1, 2))
         return src, pos
 
 
+def load_weights(model_path):
+    """Load the ``params`` state dict of a checkpoint, memory-mapping the file when possible.
+
+    Memory-mapped tensors are paged in lazily and, since they are assigned to the model
+    as-is, processes loading the same file share its page-cache pages instead of each
+    holding a private copy. Weights stored in half precision by ``ddcolor_export.py deploy``
+    are upcast to float32.
+    """
+    try:
+        checkpoint = torch.load(model_path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # Legacy (non-zip) checkpoints cannot be memory-mapped
+        checkpoint = torch.load(model_path, map_location='cpu')
+    state_dict = checkpoint['params']
+    return {key: tensor.float() if tensor.is_floating_point() else tensor for key, tensor in state_dict.items()}
+
+
+PRECISIONS = ['fp32', 'bf16', 'int8']
+UPSAMPLE_MODES = ['nearest', 'bilinear', 'guided']
+MANIFEST_NAME = 'ddcolor_manifest.db'
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+ARCHIVE_SUFFIXES = ('.zip', '.cbz')
+PARTIAL_SUFFIXES = ('.tmp', '.part', '.crdownload', '.download')
+# Full resolution colour conversions run in bands of this many rows, see `merge_lab`
+BAND_ROWS = 256
+FROZEN_SUFFIX = '.pt'
+ONNX_SUFFIX = '.onnx'
+
+
+def cpu_supports_bf16():
+    """Whether the CPU has native bf16 support (AVX512-BF16 / AMX) usable by oneDNN."""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def load_frozen_model(model_path):
+    """Load a frozen TorchScript artifact and the metadata it was exported with.
+
+    ``optimize_for_inference`` rewrites the graph with backend specific ops that cannot be
+    serialized, so it runs here, on the already frozen graph, which only takes a moment.
+    """
+    extra_files = {'ddcolor.json': ''}
+    model = torch.jit.optimize_for_inference(torch.jit.load(model_path, map_location='cpu', _extra_files=extra_files))
+    return model, json.loads(extra_files['ddcolor.json'])
+
+
+class OnnxModel:
+    """Runs an ONNX graph exported by ``ddcolor_export.py onnx`` on ONNX Runtime's CPU provider.
+
+    Takes and returns torch tensors like ``DDColor``, so the pipeline's pre- and
+    post-processing are shared with the PyTorch backend.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError('加载 .onnx 模型需要安装 onnxruntime：pip install onnxruntime')
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_size = model_input.shape[-1]
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {self.input_name: x.numpy()})[0])
+
+
 class ImageColorizationPipeline:
-    def __init__(self, model_path, input_size=256, model_size='large'):
+    def __init__(self, model_path, input_size=256, model_size='large', deploy=True, precision='fp32',
+                 upsample='nearest'):
+        self.model_path = model_path
         self.input_size = input_size
         self.device = torch.device('cpu')
+        assert upsample in UPSAMPLE_MODES, f'不支持的上采样方式：{upsample}'
+        self.upsample = upsample
 
         self.encoder_name = 'convnext-t' if model_size == 'tiny' else 'convnext-l'
         self.decoder_type = 'MultiScaleColorDecoder'
-
-        self.model = DDColor(
-            encoder_name=self.encoder_name,
-            decoder_name=self.decoder_type,
-            input_size=[self.input_size, self.input_size],
-            num_output_channels=2,
-            last_norm='Spectral',
-            do_normalize=False,
-            num_queries=100,
-            num_scales=3,
-            dec_layers=9,
-        ).to(self.device)
+        self.max_batch_size = None
+        self.tracer = None
+        self.model_stage = 'model'
+
+        assert precision in PRECISIONS, f'不支持的精度：{precision}'
+        if model_path.endswith(FROZEN_SUFFIX):
+            # Frozen TorchScript artifact from `ddcolor_export.py jit`, already converted for deploy
+            self.model, meta = load_frozen_model(model_path)
+            assert meta['input_size'] == input_size, f"{model_path} 导出时的输入尺寸为 {meta['input_size']}"
+            self.max_batch_size = meta['max_batch_size']
+            if precision != 'fp32':
+                print(f'固化模型只支持 fp32 推理，忽略精度设置 {precision}')
+            self.precision = 'fp32'
+            return
+        if model_path.endswith(ONNX_SUFFIX):
+            self.model = OnnxModel(model_path)
+            assert self.model.input_size == input_size, f"{model_path} 导出时的输入尺寸为 {self.model.input_size}"
+            if precision != 'fp32':
+                print(f'ONNX 模型只支持 fp32 推理，忽略精度设置 {precision}')
+            self.precision = 'fp32'
+            return
+
+        # Build on the meta device: no memory is allocated and no random init runs,
+        # the checkpoint tensors are assigned to the modules directly afterwards.
+        with torch.device('meta'):
+            self.model = DDColor(
+                encoder_name=self.encoder_name,
+                decoder_name=self.decoder_type,
+                input_size=[self.input_size, self.input_size],
+                num_output_channels=2,
+                last_norm='Spectral',
+                do_normalize=False,
+                num_queries=100,
+                num_scales=3,
+                dec_layers=9,
+            )
 
         # Load model weights
-        self.model.load_state_dict(
-            torch.load(model_path, map_location='cpu')['params'],
-            #torch.load(model_path, map_location='cpu'),
-            strict=True
-        )
+        self.model.load_state_dict(load_weights(model_path), strict=True, assign=True)
+        self.model.to(self.device)
         self.model.eval()
+        if deploy:
+            self.model.switch_to_deploy()
+
+        if precision == 'bf16' and not cpu_supports_bf16():
+            print('当前 CPU 不支持 bf16 指令，使用 fp32 推理')
+            precision = 'fp32'
+        self.precision = precision
+        if precision == 'bf16':
+            # The ConvNeXt depthwise convs and the permuted pointwise linears run fastest in NHWC
+            self.model.encoder.to(memory_format=torch.channels_last)
+        elif precision == 'int8':
+            # Dynamic int8 quantization of the ConvNeXt pointwise layers and the decoder
+            # FFN/MLP. The attention projections of nn.MultiheadAttention are raw
+            # parameters (or NonDynamicallyQuantizableLinear) and stay in fp32.
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
+
+    def set_tracer(self, tracer):
+        """Record the time of every stage in ``tracer``, a ``StageTracer``.
+
+        On PyTorch models the encoder and the decoder are timed separately with forward
+        hooks; frozen and ONNX models are timed as a whole.
+        """
+        self.tracer = tracer
+        if isinstance(self.model, nn.Module) and hasattr(self.model, 'encoder'):
+            tracer.hook(self.model.encoder, self.model.encoder, 'encoder')
+            tracer.hook(self.model.decoder, self.model.refine_net, 'decoder')
+            self.model_stage = None
+
+    def _stage(self, name):
+        return self.tracer.stage(name) if self.tracer is not None and name is not None else _NO_STAGE
 
     @torch.no_grad()
     def process(self, img):
-        height, width = img.shape[:2]
-
-        img = (img / 255.0).astype(np.float32)
-        orig_l = cv2.cvtColor(img, cv2.COLOR_BGR2Lab)[:, :, :1]  # (h, w, 1)
+        return self.process_batch([img])[0]
 
+    @torch.no_grad()
+    def process_batch(self, images):
+        """Colorize a list of BGR images with a single forward pass.
+
+        Images may have different sizes: each one is resized to ``input_size`` for the
+        model and its ab prediction is upsampled back to its own resolution.
+        """
+        if len(images) == 0:
+            return []
+
+        prepared = [self.preprocess(img) for img in images]
+        output_ab = self.infer([tensor for _, tensor in prepared])
+
+        return [self.postprocess(orig_l, ab.unsqueeze(0)) for (orig_l, _), ab in zip(prepared, output_ab)]
+
+    def preprocess(self, img):
+        """Return the full-resolution L channel and the model input tensor of a BGR image."""
+        with self._stage('preprocess'):
+            gray = gray_plane(img)
+            if gray is not None:
+                # Gray page: L comes from a table and only one float plane is resized
+                small = cv2.resize(np.divide(gray, np.float32(255.0), dtype=np.float32), (self.input_size,) * 2)
+                return gray_to_l(gray), self._to_tensor(cv2.cvtColor(small, cv2.COLOR_GRAY2BGR))
+            # Same values as (img / 255.0).astype(np.float32) without the float64 copy
+            img = np.divide(img, np.float32(255.0), dtype=np.float32)
+            return bgr_to_l(img), self._to_tensor(img)
+
+    def _to_tensor(self, img):
         # Resize and convert image to grayscale
         img_resized = cv2.resize(img, (self.input_size, self.input_size))
         img_l = cv2.cvtColor(img_resized, cv2.COLOR_BGR2Lab)[:, :, :1]
         img_gray_lab = np.concatenate((img_l, np.zeros_like(img_l), np.zeros_like(img_l)), axis=-1)
         img_gray_rgb = cv2.cvtColor(img_gray_lab, cv2.COLOR_LAB2RGB)
 
-        tensor_gray_rgb = torch.from_numpy(img_gray_rgb.transpose((2, 0, 1))).float().unsqueeze(0).to(self.device)
-        output_ab = self.model(tensor_gray_rgb).cpu()  # (1, 2, self.input_size, self.input_size)
+        return torch.from_numpy(img_gray_rgb.transpose((2, 0, 1))).float().unsqueeze(0)
+
+    @torch.no_grad()
+    def infer(self, tensors):
+        """Run the model on a list of preprocessed tensors, returns (n, 2, input_size, input_size) ab."""
+        tensor_gray_rgb = torch.cat(tensors, dim=0).to(self.device)
+        with self._stage(self.model_stage):
+            if self.max_batch_size is not None and len(tensor_gray_rgb) > self.max_batch_size:
+                return torch.cat([self._forward(chunk) for chunk in tensor_gray_rgb.split(self.max_batch_size)])
+            return self._forward(tensor_gray_rgb)
+
+    def _forward(self, tensor_gray_rgb):
+        if self.precision != 'bf16':
+            return self.model(tensor_gray_rgb).cpu()
+
+        tensor_gray_rgb = tensor_gray_rgb.contiguous(memory_format=torch.channels_last)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return self.model(tensor_gray_rgb).float().cpu()
+
+    def postprocess(self, orig_l, output_ab):
+        """Upsample a (1, 2, h, w) ab prediction to the size of ``orig_l`` and return a BGR image."""
+        with self._stage('upsample'):
+            output_ab_resized = self._upsample_ab(output_ab, orig_l, self.upsample)
+        with self._stage('postprocess'):
+            return merge_lab(orig_l, output_ab_resized)
+
+    @staticmethod
+    def _upsample_ab(output_ab, orig_l, mode):
+        """Upsample a (1, 2, h, w) ab prediction to the (height, width, 2) size of ``orig_l``."""
+        height, width = orig_l.shape[:2]
+        if mode == 'guided':
+            return guided_upsample(output_ab[0].float().numpy().transpose(1, 2, 0), orig_l[:, :, 0], guide_range=100.0)
+        align_corners = False if mode == 'bilinear' else None
+        output_ab = F.interpolate(output_ab, size=(height, width), mode=mode, align_corners=align_corners)
+        return output_ab[0].float().numpy().transpose(1, 2, 0)
 
-        # Resize output and concatenate with original L channel
-        output_ab_resized = F.interpolate(output_ab, size=(height, width))[0].float().numpy().transpose(1, 2, 0)
-        output_lab = np.concatenate((orig_l, output_ab_resized), axis=-1)
-        output_bgr = cv2.cvtColor(output_lab, cv2.COLOR_LAB2BGR)
+    @torch.no_grad()
+    def process_tiled(self, img, overlap=64, batch_size=8, blank_range=2):
+        """Colorize a BGR page tile by tile at the model's native resolution.
+
+        The page is cut into ``input_size`` tiles overlapping by ``overlap`` pixels, the tiles
+        of each row go through the model in batches of ``batch_size`` and their ab predictions
+        are blended with feathered weights. Tiles whose gray levels span at most
+        ``blank_range`` (pure white or empty) skip the model and stay neutral.
+
+        Tile rows are blended in a band buffer as wide as the page and one tile tall, and
+        finished rows are converted to BGR right away, so apart from the input and output
+        images memory does not grow with the page size.
+        """
+        height, width = img.shape[:2]
+        tile_h, tile_w = min(self.input_size, height), min(self.input_size, width)
+        overlap = min(overlap, self.input_size // 2)
+        xs = _tile_starts(width, tile_w, self.input_size - overlap)
+        ys = _tile_starts(height, tile_h, self.input_size - overlap)
+        weight = np.outer(_feather(tile_h, overlap), _feather(tile_w, overlap))[:, :, None]
+        # Nearest upsampling would leave block edges inside the blended tiles
+        mode = 'guided' if self.upsample == 'guided' else 'bilinear'
+
+        output_img = np.empty((height, width, 3), np.uint8)
+        acc_ab = np.zeros((tile_h, width, 2), np.float32)
+        acc_w = np.zeros((tile_h, width, 1), np.float32)
+        band_top = 0
+        for y in ys + [height]:
+            # Rows above this tile row are final: merge them with L and shift the band
+            done = y - band_top
+            if done > 0:
+                rows = slice(band_top, y)
+                with self._stage('preprocess'):
+                    gray = gray_plane(img[rows])
+                    img_l = gray_to_l(gray) if gray is not None else \
+                        bgr_to_l(np.divide(img[rows], np.float32(255.0), dtype=np.float32))
+                with self._stage('postprocess'):
+                    merge_lab(img_l, acc_ab[:done] / acc_w[:done], out=output_img[rows])
+                acc_ab[:-done], acc_w[:-done] = acc_ab[done:].copy(), acc_w[done:].copy()
+                acc_ab[-done:], acc_w[-done:] = 0, 0
+                band_top = y
+            if y == height:
+                break
+
+            tiles = [(x, img[y:y + tile_h, x:x + tile_w]) for x in xs]
+            for x, _ in tiles:
+                acc_w[:, x:x + tile_w] += weight
+            tiles = [(x, tile) for x, tile in tiles if int(tile.max()) - int(tile.min()) > blank_range]
+            for start in range(0, len(tiles), batch_size):
+                chunk = tiles[start:start + batch_size]
+                with self._stage('preprocess'):
+                    tiles_float = [(tile / 255.0).astype(np.float32) for _, tile in chunk]
+                    tensors = [self._to_tensor(tile) for tile in tiles_float]
+                output_ab = self.infer(tensors)
+                with self._stage('upsample'):
+                    for (x, _), tile, ab in zip(chunk, tiles_float, output_ab):
+                        tile_l = cv2.cvtColor(tile, cv2.COLOR_BGR2Lab)[:, :, :1] if mode == 'guided' else tile[:, :, :1]
+                        acc_ab[:, x:x + tile_w] += self._upsample_ab(ab.unsqueeze(0), tile_l, mode) * weight
 
-        output_img = (output_bgr * 255.0).round().astype(np.uint8)
         return output_img
 
 
+def guided_upsample(ab, guide, radius=2, eps=1e-3, guide_range=1.0):
+    """Upsample a low resolution ab map to the size of ``guide`` with a fast guided filter.
+
+    The local linear model ``ab = a * guide + b`` is fitted on the low resolution grid
+    (He & Sun, "Fast Guided Filter", 2015), then ``a`` and ``b`` are upsampled bilinearly
+    and applied to the full resolution guide, so colour edges follow the edges of the L
+    channel instead of the model's pixel grid. Every step is a box filter or a resize,
+    so the cost is linear in the number of pixels.
+
+    The coefficients are upsampled and applied in bands of ``BAND_ROWS`` rows, so the
+    returned ab map is the only full resolution buffer, as for the other upsample modes.
+
+    Args:
+        ab (ndarray): (h, w, 2) float32 ab prediction.
+        guide (ndarray): (H, W) float32 guide, e.g. the L channel.
+        radius (int): Box filter radius on the low resolution grid.
+        eps (float): Regularization, larger values smooth more across edges.
+        guide_range (float): The guide is divided by this to bring it to [0, 1], 100 for L.
+    """
+    height, width = guide.shape[:2]
+    low_h, low_w = ab.shape[:2]
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    guide_range = np.float32(guide_range)
+
+    def box(x):
+        return cv2.boxFilter(x, -1, ksize, borderType=cv2.BORDER_REFLECT)
+
+    guide_low = cv2.resize(guide.astype(np.float32, copy=False), (low_w, low_h), interpolation=cv2.INTER_AREA)
+    guide_low = (guide_low / guide_range)[:, :, None]
+    mean_i = box(guide_low)[:, :, None]
+    mean_p = box(ab)
+    cov_ip = box(guide_low * ab) - mean_i * mean_p
+    var_i = box(guide_low * guide_low)[:, :, None] - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+
+    # Bilinear resizing is separable: widen the coefficient rows once at low height, then
+    # interpolate each band of output rows between the two nearest of them
+    coeffs = cv2.resize(np.concatenate((box(a), box(b)), axis=-1), (width, low_h), interpolation=cv2.INTER_LINEAR)
+    out = np.empty((height, width, 2), np.float32)
+    band = np.empty((min(BAND_ROWS, height), width, 4), np.float32)
+    below = np.empty_like(band)
+    for top in range(0, height, BAND_ROWS):
+        n = min(BAND_ROWS, height - top)
+        y = ((np.arange(top, top + n, dtype=np.float32) + 0.5) * np.float32(low_h / height) - 0.5).clip(0, low_h - 1)
+        y0 = y.astype(np.int64)
+        np.take(coeffs, y0, axis=0, out=band[:n])
+        np.take(coeffs, np.minimum(y0 + 1, low_h - 1), axis=0, out=below[:n])
+        below[:n] -= band[:n]
+        below[:n] *= (y - y0)[:, None, None]
+        band[:n] += below[:n]
+        np.multiply(band[:n, :, :2], (guide[top:top + n] / guide_range)[:, :, None], out=out[top:top + n])
+        out[top:top + n] += band[:n, :, 2:]
+    return out
+
+
+def bgr_to_l(img):
+    """L channel (H, W, 1) of a float32 BGR image in [0, 1], converted in bands of ``BAND_ROWS`` rows."""
+    height, width = img.shape[:2]
+    l = np.empty((height, width, 1), np.float32)
+    lab = np.empty((min(BAND_ROWS, height), width, 3), np.float32)
+    for top in range(0, height, BAND_ROWS):
+        n = min(BAND_ROWS, height - top)
+        cv2.cvtColor(img[top:top + n], cv2.COLOR_BGR2Lab, dst=lab[:n])
+        l[top:top + n] = lab[:n, :, :1]
+    return l
+
+
+def gray_plane(img):
+    """The gray levels of a uint8 BGR image whose three channels are equal, otherwise None."""
+    gray = img[:, :, 0]
+    if np.array_equal(gray, img[:, :, 1]) and np.array_equal(gray, img[:, :, 2]):
+        return gray
+    return None
+
+
+# L of every 8-bit gray level, computed by the same float conversion as `bgr_to_l`
+GRAY_L = bgr_to_l(np.divide(np.repeat(np.arange(256, dtype=np.uint8)[None, :, None], 3, axis=2),
+                            np.float32(255.0), dtype=np.float32))[0, :, 0]
+
+
+def gray_to_l(gray):
+    """L channel (H, W, 1) of a uint8 gray plane, one table lookup per pixel."""
+    return GRAY_L[gray][:, :, None]
+
+
+def merge_lab(l, ab, out=None):
+    """Merge (H, W, 1) L and (H, W, 2) ab float32 planes into a uint8 BGR image.
+
+    The planes are merged, converted and rounded in bands of ``BAND_ROWS`` rows through two
+    reused float buffers and written straight into the uint8 output, with the same result
+    as converting the whole page at once. Together with the float32 L plane kept by
+    ``preprocess`` and the upsampled ab (in every upsample mode, ``guided_upsample`` also
+    works in bands), a page peaks at about 20 bytes per pixel
+    (~20 MB per megapixel) on top of the decoded image, and long strips no longer need
+    several full-page float copies.
+    """
+    height, width = l.shape[:2]
+    out = np.empty((height, width, 3), np.uint8) if out is None else out
+    lab = np.empty((min(BAND_ROWS, height), width, 3), np.float32)
+    bgr = np.empty_like(lab)
+    for top in range(0, height, BAND_ROWS):
+        n = min(BAND_ROWS, height - top)
+        lab[:n, :, :1] = l[top:top + n]
+        lab[:n, :, 1:] = ab[top:top + n]
+        cv2.cvtColor(lab[:n], cv2.COLOR_LAB2BGR, dst=bgr[:n])
+        np.multiply(bgr[:n], 255.0, out=bgr[:n])
+        np.rint(bgr[:n], out=bgr[:n])
+        out[top:top + n] = bgr[:n]
+    return out
+
+
+def _tile_starts(length, tile, stride):
+    """Start offsets of tiles of size ``tile`` covering ``length`` with at most ``stride`` between them."""
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+def _feather(length, overlap):
+    """1-D blending weights that ramp up over ``overlap`` pixels at both ends of a tile."""
+    ramp = np.minimum(np.arange(length) + 0.5, np.arange(length)[::-1] + 0.5) / max(overlap, 1)
+    return np.clip(ramp, 1e-3, 1.0).astype(np.float32)
+
+
+class OutputCache:
+    """Persistent on-disk cache of colorized pages, keyed by content instead of file name.
+
+    A key combines a hash of the decoded page's pixels with a hash of the model weights
+    and the options that change the result, so re-uploads, rescans with identical pixels
+    and covers repeated across volumes are colorized once. Hits are hardlinked (or copied
+    across file systems) to the output path. Every hit refreshes the entry's mtime and the
+    least recently used entries are evicted once the cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def content_digest(img):
+        """Hash of what the pipeline reads from ``img``: the gray levels of a gray page, the BGR pixels otherwise."""
+        plane = gray_plane(img)
+        plane = img if plane is None else plane
+        digest = hashlib.blake2b(np.ascontiguousarray(plane).data, digest_size=16)
+        digest.update(str(plane.shape).encode())
+        return digest.hexdigest()
+
+    def model_prefix(self, colorizer, tile_overlap=None):
+        """Hash of the weights of ``colorizer`` and of the options that affect its output."""
+        if colorizer.model_path not in self.fingerprints:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(colorizer.model_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.fingerprints[colorizer.model_path] = digest.hexdigest()
+        options = [colorizer.input_size, colorizer.precision, colorizer.upsample, tile_overlap]
+        return self.fingerprints[colorizer.model_path] + json.dumps(options)
+
+    def key(self, prefix, content_digest):
+        return hashlib.blake2b((prefix + content_digest).encode(), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+    def get(self, key, output):
+        """Place the cached result for ``key`` at ``output``, returns False on a miss.
+
+        ``output`` is a file path, or a callable that receives the encoded image.
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+            if callable(output):
+                with open(path, 'rb') as f:
+                    output(f.read())
+            else:
+                _link_or_copy(path, output)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, data, output_path=None):
+        """Add the encoded image ``data``, hardlinked from ``output_path`` when it was written to a file.
+
+        Identical pages in flight together all miss and all put their result, only the first
+        one is stored and counted.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            if os.path.exists(path):
+                return
+            if output_path is not None:
+                _link_or_copy(output_path, path)
+            else:
+                # Processes sharing the cache may store the same key, so the temporary file is private
+                write_atomic(path, data, _private_temp_path(path))
+            self.total_bytes += os.path.getsize(path)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                # Skip the partial files of writes in flight or interrupted
+                if name.endswith('.png') and not name.endswith('.tmp.png'):
+                    stat = os.stat(os.path.join(root, name))
+                    yield os.path.join(root, name), stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        # Rescan, other processes may share the cache directory
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.total_bytes = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+
+def _private_temp_path(path):
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def _link_or_copy(src, dst):
+    tmp_path = _private_temp_path(dst)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def temp_output_path(output_path):
+    root, ext = os.path.splitext(output_path)
+    return f'{root}.tmp{ext}'
+
+
+def remove_partial_outputs(output_dir):
+    """Remove the temporary files (``temp_output_path``) an interrupted run left in ``output_dir``."""
+    removed = 0
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            root, ext = os.path.splitext(entry.name)
+            if root.endswith('.tmp') and ext.lower() in ('.png',) + ARCHIVE_SUFFIXES and entry.is_file():
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+
+def write_atomic(path, data, tmp_path=None):
+    tmp_path = tmp_path or temp_output_path(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def entry_name(entry):
+    """File name of a page, or ``archive/member`` for a page inside an archive."""
+    if isinstance(entry, str):
+        return os.path.basename(entry)
+    archive_path, member = entry
+    return f'{os.path.basename(archive_path)}/{member}'
+
+
+def is_archive_page(name):
+    return name.lower().endswith(IMAGE_SUFFIXES) and not name.startswith('__MACOSX/')
+
+
+def archive_pages(archive_path):
+    """Image members of a zip/cbz archive in reading order."""
+    with zipfile.ZipFile(archive_path) as archive:
+        names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    return sorted(name for name in names if is_archive_page(name))
+
+
+def page_output_names(members):
+    """Output member name of every archive page, its name with a ``.png`` extension.
+
+    Pages that would share a name (``001.jpg`` next to ``001.png``) keep their original
+    extension in the stem instead (``001.jpg.png``); a page already named so keeps its name.
+    """
+    targets = {member: os.path.splitext(member)[0] + '.png' for member in members}
+    counts = Counter(targets.values())
+    return {member: target if counts[target] == 1 or member == target else member + '.png'
+            for member, target in targets.items()}
+
+
+@functools.lru_cache(maxsize=16)
+def _open_archive(archive_path):
+    # ZipFile serializes access to the underlying file, so reader threads can share it
+    return zipfile.ZipFile(archive_path)
+
+
+def read_image(source):
+    """Decode a page from a file path or, in memory, from an ``(archive_path, member)`` pair."""
+    if isinstance(source, str):
+        return cv2.imread(source)
+    archive_path, member = source
+    try:
+        data = _open_archive(archive_path).read(member)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+class ArchiveWriter:
+    """Writes colorized pages into their ``(archive_path, member)`` outputs.
+
+    An archive is built in a temporary file and renamed into place once all its pages
+    finished, with the non-page members of its source copied over; an archive with a
+    failed page is discarded, so the next run processes it again.
+    """
+
+    def __init__(self, tasks):
+        self.remaining = {}
+        self.sources = {}
+        for source, outputs in tasks:
+            for output in outputs:
+                if isinstance(output, tuple):
+                    self.remaining[output[0]] = self.remaining.get(output[0], 0) + 1
+                    self.sources[output[0]] = source[0]
+        self.archives = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def write(self, output, data):
+        archive_path, member = output
+        with self.lock:
+            if archive_path not in self.archives:
+                self.archives[archive_path] = zipfile.ZipFile(temp_output_path(archive_path), 'w', zipfile.ZIP_STORED)
+            self.archives[archive_path].writestr(member, data)
+
+    def finished(self, output, error=None):
+        archive_path, _ = output
+        with self.lock:
+            self.remaining[archive_path] -= 1
+            if error is not None:
+                self.failed.add(archive_path)
+            if self.remaining[archive_path] > 0:
+                return
+            archive = self.archives.pop(archive_path, None)
+            if archive_path in self.failed:
+                if archive is not None:
+                    archive.close()
+                    os.remove(temp_output_path(archive_path))
+                print(f"{os.path.basename(archive_path)} 中有页面处理失败，未生成该压缩包")
+                return
+            if archive is None:
+                return
+
+            source = _open_archive(self.sources[archive_path])
+            for info in source.infolist():
+                if not info.is_dir() and not is_archive_page(info.filename):
+                    # A fresh ZipInfo, writing updates offsets the shared source still reads from
+                    copied = zipfile.ZipInfo(info.filename, info.date_time)
+                    copied.compress_type, copied.external_attr = info.compress_type, info.external_attr
+                    archive.writestr(copied, source.read(info))
+            archive.close()
+            os.replace(temp_output_path(archive_path), archive_path)
+
+
+class JobManifest:
+    """SQLite record of every output of a run: its page, model, state, duration and error.
+
+    Outputs are keyed by file name, so the manifest stays valid when the output folder is
+    moved. A single connection is shared by the pipeline threads behind a lock, and WAL
+    mode lets the processes of ``run_workers`` update the same file. Because outputs are
+    written to a temporary file and renamed, a ``done`` row always has a complete image and
+    ``--resume`` can skip those without touching the file system.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (output TEXT PRIMARY KEY, input TEXT, model TEXT, '
+                              'state TEXT, duration REAL, error TEXT, updated REAL)')
+
+    def done_outputs(self):
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT output FROM jobs WHERE state = 'done'")}
+
+    def add(self, jobs):
+        """Register ``(source, model_path, output)`` jobs as pending."""
+        rows = [(entry_name(output), entry_name(source), os.path.basename(model_path), time.time())
+                for source, model_path, output in jobs]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, 'pending', NULL, NULL, ?)", rows)
+
+    def mark(self, output, duration, error=None):
+        """``duration`` is the time spent processing the output, without waiting in queues."""
+        state = 'failed' if error is not None else 'done'
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE jobs SET state = ?, duration = ?, error = ?, updated = ? WHERE output = ?',
+                              (state, duration, error, time.time(), entry_name(output)))
+
+    def close(self):
+        self.conn.close()
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+class StageTracer:
+    """Per-page wall time of the pipeline stages, written as JSON lines or CSV.
+
+    Threads ``bind`` the pages they work on, by input name, and the model file the stages
+    belong to. A batched stage is split evenly over its pages, repeated stages of a page
+    add up in the summary.
+    """
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # stage -> (image, model) -> ms
+        self.times = defaultdict(lambda: defaultdict(float))
+        self.file = open(path, 'w', newline='', encoding='utf-8') if path else None
+        self.csv = csv.writer(self.file) if path and path.endswith('.csv') else None
+        if self.csv is not None:
+            self.csv.writerow(['image', 'model', 'stage', 'ms', 'batch_size'])
+
+    def bind(self, names, model=None):
+        self.local.names = names
+        self.local.model = model
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def hook(self, first_module, last_module, name):
+        """Time ``name`` from the forward call of ``first_module`` to the end of ``last_module``."""
+        def start(module, args):
+            self.local.started = time.perf_counter()
+
+        def stop(module, args, output):
+            self.record(name, time.perf_counter() - self.local.started)
+
+        first_module.register_forward_pre_hook(start)
+        last_module.register_forward_hook(stop)
+
+    def record(self, stage, seconds):
+        names = getattr(self.local, 'names', None) or ['-']
+        model = getattr(self.local, 'model', None)
+        ms = seconds * 1000 / len(names)
+        with self.lock:
+            for name in names:
+                self.times[stage][name, model] += ms
+            if self.csv is not None:
+                self.csv.writerows([name, model or '', stage, f'{ms:.3f}', len(names)] for name in names)
+            elif self.file is not None:
+                self.file.writelines(json.dumps({'image': name, 'model': model, 'stage': stage, 'ms': round(ms, 3),
+                                                 'batch_size': len(names)}, ensure_ascii=False) + '\n'
+                                     for name in names)
+
+    def summary(self):
+        """Per stage count, mean, p50/p95/p99 and total in milliseconds per page and model."""
+        summary = {}
+        for stage, times in self.times.items():
+            times = np.fromiter(times.values(), np.float64, len(times))
+            p50, p95, p99 = np.percentile(times, [50, 95, 99])
+            summary[stage] = dict(count=len(times), mean=times.mean(), p50=p50, p95=p95, p99=p99, total=times.sum())
+        return summary
+
+    def close(self):
+        summary = self.summary()
+        total = sum(stats['total'] for stats in summary.values()) or 1
+        print(f"\n{'阶段':<12}{'次数':>8}{'平均':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'占比':>8}  （毫秒/张）")
+        for stage, stats in summary.items():
+            print(f"{stage:<12}{stats['count']:>10}{stats['mean']:>10.2f}{stats['p50']:>10.2f}{stats['p95']:>10.2f}"
+                  f"{stats['p99']:>10.2f}{stats['total'] / total:>9.1%}")
+        if self.file is not None:
+            if self.csv is None:
+                self.file.write(json.dumps({'summary': summary}) + '\n')
+            self.file.close()
+
+
+def check_precision(model_path, input_dir, precision, input_size=256, model_size='large', max_images=16):
+    """Compare a reduced precision pipeline with fp32 on up to ``max_images`` pages of ``input_dir``.
+
+    Reports the mean and max absolute ab error at model resolution, the mean
+    colorfulness change of the final images and the inference speedup.
+    """
+    reference = ImageColorizationPipeline(model_path, input_size=input_size, model_size=model_size)
+    candidate = ImageColorizationPipeline(model_path, input_size=input_size, model_size=model_size, precision=precision)
+
+    ab_errors, ab_max, cf_deltas, times = [], 0.0, [], [0.0, 0.0]
+    for file_name in sorted(os.listdir(input_dir))[:max_images]:
+        img = cv2.imread(os.path.join(input_dir, file_name))
+        if img is None:
+            continue
+        orig_l, tensor = reference.preprocess(img)
+
+        outputs = []
+        for k, colorizer in enumerate((reference, candidate)):
+            start = time.perf_counter()
+            outputs.append(colorizer.infer([tensor]))
+            times[k] += time.perf_counter() - start
+
+        diff = (outputs[0] - outputs[1]).abs()
+        ab_errors.append(diff.mean().item())
+        ab_max = max(ab_max, diff.max().item())
+        cf_deltas.append(calculate_cf(reference.postprocess(orig_l, outputs[1])) -
+                         calculate_cf(reference.postprocess(orig_l, outputs[0])))
+
+    assert len(ab_errors) > 0, "输入目录中没有可读取的图片"
+    print(f'{precision} 与 fp32 对比（{len(ab_errors)} 张图片）：')
+    print(f'  ab 平均绝对误差：{np.mean(ab_errors):.4f}，最大误差：{ab_max:.4f}')
+    print(f'  色彩丰富度变化：平均 {np.mean(cf_deltas):+.3f}，最大 {np.max(np.abs(cf_deltas)):.3f}')
+    print(f'  推理耗时：fp32 {times[0] / len(ab_errors) * 1000:.1f} ms/张，'
+          f'{precision} {times[1] / len(ab_errors) * 1000:.1f} ms/张，加速 {times[0] / times[1]:.2f}x')
+
+
+def run_pipeline(colorizers, tasks, batch_size=1, read_threads=2, write_threads=2, queue_depth=8, tile_overlap=None,
+                 tile_batch_size=8, cache=None, manifest=None, tracer=None, pbar=None):
+    """Colorize ``(source, outputs)`` tasks, overlapping decode, inference and encode.
+
+    ``source`` is an image path or an ``(archive_path, member)`` pair. ``outputs[k]`` is
+    where the result of ``colorizers[k]`` goes: a path, an ``(archive_path, member)`` pair
+    or None to skip that model. Each page is decoded once for all models. Reader threads
+    decode and preprocess, the calling thread runs the models and writer threads finish
+    and encode, with at most ``queue_depth`` pages waiting on either side.
+    """
+    tasks = list(tasks)
+    archives = ArchiveWriter(tasks)
+    queue_depth = max(queue_depth, batch_size)
+    write_slots = threading.BoundedSemaphore(queue_depth)
+    # All models share input_size, so any of them can prepare and finish a page.
+    colorizer = colorizers[0]
+
+    cache_prefixes = [cache.model_prefix(model, tile_overlap) for model in colorizers] if cache is not None else None
+    stage = tracer.stage if tracer is not None else lambda name: _NO_STAGE
+    model_names = [os.path.basename(model.model_path) for model in colorizers]
+
+    def finished(output, spent, error=None):
+        if manifest is not None:
+            manifest.mark(output, spent, error)
+        if isinstance(output, tuple):
+            archives.finished(output, error)
+        if pbar is not None:
+            pbar.update(1)
+
+    def read(task):
+        # Returns the seconds spent decoding and preparing the page as well
+        start = time.perf_counter()
+        if tracer is not None:
+            tracer.bind([entry_name(task[0])])
+        with stage('decode'):
+            img = read_image(task[0])
+        if img is None:
+            return task, time.perf_counter() - start, None, None
+        keys = [None] * len(colorizers)
+        if cache is not None:
+            digest = cache.content_digest(img)
+            keys = [cache.key(prefix, digest) for prefix in cache_prefixes]
+            output_paths = list(task[1])
+            for k, output in enumerate(output_paths):
+                target = functools.partial(archives.write, output) if isinstance(output, tuple) else output
+                if output is not None and cache.get(keys[k], target):
+                    output_paths[k] = None
+                    finished(output, time.perf_counter() - start)
+            task = (task[0], output_paths)
+            if all(output_path is None for output_path in output_paths):
+                return task, time.perf_counter() - start, img, keys
+        if tile_overlap is None:
+            img = colorizer.preprocess(img)
+        return task, time.perf_counter() - start, img, keys
+
+    def write(page, model_name, output, key, spent, finish, *args):
+        start = time.perf_counter()
+        error = None
+        if tracer is not None:
+            tracer.bind([page], model_name)
+        try:
+            in_archive = isinstance(output, tuple)
+            image = finish(*args)
+            with stage('encode'):
+                ok, data = cv2.imencode(os.path.splitext(output[1] if in_archive else output)[1], image)
+            if ok:
+                with stage('write'):
+                    if in_archive:
+                        archives.write(output, data)
+                    else:
+                        write_atomic(output, data)
+                if key is not None:
+                    try:
+                        cache.put(key, data, None if in_archive else output)
+                    except OSError as e:
+                        # The output itself is complete, only the cache misses this page
+                        print(f"缓存写入失败：{output}，错误：{e}")
+            else:
+                error = '写入失败'
+                print(f"写入失败：{output}")
+        except Exception as e:
+            error = str(e)
+            print(f"写入失败：{output}，错误：{e}")
+        finally:
+            write_slots.release()
+            finished(output, spent + time.perf_counter() - start, error)
+
+    def run_batch(batch):
+        for k, model in enumerate(colorizers):
+            model_name = model_names[k]
+            items = [(entry_name(task[0]), task[1][k], keys[k], spent, prepared)
+                     for task, spent, prepared, keys in batch if task[1][k] is not None]
+            if len(items) == 0:
+                continue
+            if tile_overlap is not None:
+                for page, output_path, key, spent, img in items:
+                    if tracer is not None:
+                        tracer.bind([page], model_name)
+                    start = time.perf_counter()
+                    image_out = model.process_tiled(img, overlap=tile_overlap, batch_size=tile_batch_size)
+                    spent += time.perf_counter() - start
+                    write_slots.acquire()
+                    writers.submit(write, page, model_name, output_path, key, spent, np.asarray, image_out)
+                continue
+
+            if tracer is not None:
+                tracer.bind([page for page, _, _, _, _ in items], model_name)
+            start = time.perf_counter()
+            output_ab = model.infer([tensor for _, _, _, _, (_, tensor) in items])
+            # Each page is charged its share of the batched forward pass
+            share = (time.perf_counter() - start) / len(items)
+            for (page, output_path, key, spent, (orig_l, _)), ab in zip(items, output_ab):
+                write_slots.acquire()
+                writers.submit(write, page, model_name, output_path, key, spent + share, colorizer.postprocess,
+                               orig_l, ab.unsqueeze(0))
+
+    with ThreadPoolExecutor(read_threads) as readers, ThreadPoolExecutor(write_threads) as writers:
+        task_iter = iter(tasks)
+        reads = deque(readers.submit(read, task) for task in itertools.islice(task_iter, queue_depth))
+        batch = []
+        while reads:
+            task, spent, prepared, keys = reads.popleft().result()
+            next_task = next(task_iter, None)
+            if next_task is not None:
+                reads.append(readers.submit(read, next_task))
+
+            if prepared is None:
+                print(f"读取失败：{task[0]}")
+                for output_path in task[1]:
+                    if output_path is not None:
+                        finished(output_path, spent, '读取失败')
+            elif any(output_path is not None for output_path in task[1]):
+                batch.append((task, spent, prepared, keys))
+
+            if batch and (len(batch) == batch_size or tile_overlap is not None or not reads):
+                run_batch(batch)
+                batch = []
+
+
+def make_cache(cache_options):
+    return OutputCache(**cache_options) if cache_options is not None else None
+
+
+def split_cores(num_workers):
+    """Split the CPUs available to this process into at most ``num_workers`` contiguous groups."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    num_workers = max(1, min(num_workers, len(cores)))
+    return [cores[i * len(cores) // num_workers:(i + 1) * len(cores) // num_workers] for i in range(num_workers)]
+
+
+class _QueueProgress:
+    """Stand-in for ``tqdm`` that forwards the progress of a worker process to the parent."""
+
+    def __init__(self, progress_queue):
+        self.progress_queue = progress_queue
+
+    def update(self, n=1):
+        self.progress_queue.put(n)
+
+
+def _worker_main(cores, model_paths, tasks, model_kwargs, pipeline_kwargs, cache_options, manifest_path,
+                 progress_queue):
+    # Pin the worker to its own cores where the platform allows it and size the
+    # intra-op thread pools to match, so workers do not oversubscribe the machine.
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    cv2.setNumThreads(len(cores))
+
+    if len(tasks) == 0:
+        return
+    colorizers = [ImageColorizationPipeline(model_path=model_path, **model_kwargs) for model_path in model_paths]
+    manifest = JobManifest(manifest_path) if manifest_path is not None else None
+    run_pipeline(colorizers, tasks, cache=make_cache(cache_options), manifest=manifest,
+                 pbar=_QueueProgress(progress_queue), **pipeline_kwargs)
+
+
+def run_workers(model_paths, tasks, num_workers, model_kwargs, pipeline_kwargs, cache_options=None,
+                manifest_path=None):
+    """Shard ``tasks`` over ``num_workers`` processes.
+
+    Each process loads the models once, processes its share of the task list with its own
+    share of the CPU cores and reports progress to a single progress bar. The pages of an
+    archive all go to the same process, which writes the output archive.
+    """
+    ctx = mp.get_context('spawn')
+    core_groups = split_cores(num_workers)
+    progress_queue = ctx.Queue()
+
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task[0][0] if isinstance(task[0], tuple) else task[0], []).append(task)
+    worker_tasks = [[] for _ in core_groups]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(worker_tasks, key=len).extend(group)
+
+    workers = []
+    for worker_id, cores in enumerate(core_groups):
+        worker = ctx.Process(
+            target=_worker_main,
+            args=(cores, model_paths, worker_tasks[worker_id], model_kwargs, pipeline_kwargs, cache_options,
+                  manifest_path, progress_queue),
+            daemon=True,
+        )
+        worker.start()
+        workers.append(worker)
+    print(f'已启动 {len(workers)} 个推理进程，每个进程 {len(core_groups[0])} 个核心')
+
+    total = sum(output_path is not None for _, output_paths in tasks for output_path in output_paths)
+    with tqdm(total=total, desc='正在处理') as pbar:
+        while any(worker.is_alive() for worker in workers) or not progress_queue.empty():
+            try:
+                pbar.update(progress_queue.get(timeout=0.5))
+            except queue.Empty:
+                pass
+
+    for worker_id, worker in enumerate(workers):
+        worker.join()
+        if worker.exitcode != 0:
+            print(f'推理进程 {worker_id} 异常退出，退出码：{worker.exitcode}')
+
+
+def build_tasks(file_names, input_dir, output_dir, model_paths, input_size, done_outputs=None, force=()):
+    """Build the ``run_pipeline`` tasks and the manifest jobs for files in ``input_dir``.
+
+    Outputs that already exist are skipped, or with ``done_outputs`` from the manifest,
+    outputs recorded as done. Files in ``force`` are processed again regardless.
+    """
+    # Loop over images first so every page is decoded once for all checkpoints.
+    tasks = []
+    jobs = []
+    skipped = 0
+    for file_name in file_names:
+        input_path = os.path.join(input_dir, file_name)
+        stem, ext = os.path.splitext(file_name)
+        # Archives are colorized page by page into an archive of the same type
+        is_archive = ext.lower() in ARCHIVE_SUFFIXES
+        output_paths = []
+        for model_path in model_paths:
+            model_name = os.path.splitext(os.path.basename(model_path))[0]
+            output_name = stem + f"_{model_name}_{input_size}" + (ext if is_archive else '.png')
+            output_path = os.path.join(output_dir, output_name)
+
+            # Output archives only appear once complete, checking them is one stat per archive
+            if file_name in force:
+                pass
+            elif done_outputs is not None and not is_archive:
+                if output_name in done_outputs:
+                    skipped += 1
+                    output_path = None
+            elif os.path.exists(output_path):
+                print(f"跳过 {file_name}，输出文件已存在")
+                output_path = None
+            output_paths.append(output_path)
+        if all(output_path is None for output_path in output_paths):
+            continue
+
+        if is_archive:
+            try:
+                members = archive_pages(input_path)
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f"读取失败：{input_path}，错误：{e}")
+                continue
+            file_tasks = []
+            for member, page_name in page_output_names(members).items():
+                outputs = [(output_path, page_name) if output_path is not None else None for output_path in output_paths]
+                file_tasks.append(((input_path, member), outputs))
+        else:
+            file_tasks = [(input_path, output_paths)]
+        for source, outputs in file_tasks:
+            jobs.extend((source, model_path, output) for model_path, output in zip(model_paths, outputs)
+                        if output is not None)
+        tasks.extend(file_tasks)
+    if skipped:
+        print(f"继续上次的任务，跳过 {skipped} 个已完成的输出")
+    return tasks, jobs
+
+
+def watch_folder(input_dir, interval=2.0):
+    """Poll ``input_dir`` and yield ``(names, changed)`` for new files once they stopped changing.
+
+    A file is only handed out after its size and modification time were the same in two
+    consecutive polls, so pages still being copied or downloaded are not read half-written.
+    A file that changes again after it was handed out is handed out again and listed in
+    ``changed`` as well, its existing outputs are stale.
+    """
+    handed_out = {}
+    pending = {}
+    while True:
+        current = {}
+        with os.scandir(input_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or entry.name.endswith(PARTIAL_SUFFIXES) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if handed_out.get(entry.name) != signature:
+                    current[entry.name] = signature
+
+        ready = sorted(name for name, signature in current.items() if pending.get(name) == signature)
+        changed = {name for name in ready if name in handed_out}
+        handed_out.update((name, current[name]) for name in ready)
+        pending = {name: signature for name, signature in current.items() if handed_out.get(name) != signature}
+        if ready:
+            yield ready, changed
+        time.sleep(interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DDColor 漫画上色推理')
+    parser.add_argument('--batch-size', type=int, default=1, help='每次前向推理的图片数量')
+    parser.add_argument('--read-threads', type=int, default=2, help='读取与预处理图片的线程数')
+    parser.add_argument('--write-threads', type=int, default=2, help='后处理与保存图片的线程数')
+    parser.add_argument('--queue-depth', type=int, default=8, help='推理前后最多排队的图片数量')
+    parser.add_argument('--upsample', default='nearest', choices=UPSAMPLE_MODES,
+                        help='ab 通道上采样方式：guided 以原图亮度为引导，边缘对齐且开销很小')
+    parser.add_argument('--tiled', action='store_true', help='按模型输入尺寸分块上色并融合，适合高分辨率页面')
+    parser.add_argument('--tile-overlap', type=int, default=64, help='分块之间重叠的像素数')
+    parser.add_argument('--tile-batch-size', type=int, default=8, help='分块模式下每次前向推理的分块数量')
+    parser.add_argument('--cache-dir', default=None, help='按图片内容缓存上色结果的目录，重复页面直接复用结果')
+    parser.add_argument('--cache-size', type=float, default=10, help='缓存目录的最大容量（GB），超出后淘汰最久未使用的结果')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'按输出目录中的任务记录（{MANIFEST_NAME}）跳过已完成的图片，不再逐个检查输出文件')
+    parser.add_argument('--watch', action='store_true', help='常驻运行，模型保持加载，持续监视输入目录并处理新放入的图片')
+    parser.add_argument('--watch-interval', type=float, default=2, help='监视模式下检查输入目录的间隔（秒）')
+    parser.add_argument('--trace', default=None,
+                        help='记录每张图片各阶段（解码、预处理、编码器、解码器、上采样、编码等）的耗时，'
+                             '写入 .jsonl 或 .csv 文件，结束时打印百分位统计')
+    parser.add_argument('--workers', type=int, default=1, help='推理进程数量，CPU 核心会平均分配给各进程')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS,
+                        help='推理精度：bf16 需要支持 AVX512-BF16/AMX 的 CPU，int8 为动态量化')
+    parser.add_argument('--check-precision', action='store_true',
+                        help='在输入目录的样例图片上比较所选精度与 fp32 的误差和速度，然后退出')
+    return parser.parse_args()
+
 
 def main():
+    args = parse_args()
     print('此程序修改于阿里达摩院的DDColor项目，开源地址：https://github.com/piddnad/DDColor')
     print('此程序修改于阿里达摩院的DDColor项目，开源地址：https://github.com/piddnad/DDColor')
     print('此程序修改于阿里达摩院的DDColor项目，开源地址：https://github.com/piddnad/DDColor')
@@ -350,36 +1509,87 @@ def main():
     output_dir = os.path.join(cwd, 'after')
     input_size = 256
     model_size = 'large'
+    batch_size = max(1, args.batch_size)
 
     print(f'输出目录：{output_dir}')
     os.makedirs(output_dir, exist_ok=True)
 
-    model_files = [f for f in os.listdir(model_dir) if f.endswith('.pth')]
-    assert len(model_files) > 0, "模型目录中未找到 .pth 文件"
-
-    file_list = os.listdir(input_dir)
-    assert len(file_list) > 0, "输入目录中未找到任何图片"
-
-    for model_file in model_files:
-        model_path = os.path.join(model_dir, model_file)
+    model_files = [f for f in os.listdir(model_dir) if f.endswith(('.pth', FROZEN_SUFFIX, ONNX_SUFFIX))]
+    assert len(model_files) > 0, "模型目录中未找到 .pth、.pt 或 .onnx 文件"
+
+    if args.check_precision:
+        check_precision(os.path.join(model_dir, model_files[0]), input_dir, args.precision,
+                        input_size=input_size, model_size=model_size)
+        return
+
+    removed = remove_partial_outputs(output_dir)
+    if removed:
+        print(f'已删除上次中断留下的 {removed} 个临时文件')
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = JobManifest(manifest_path)
+    done_outputs = manifest.done_outputs() if args.resume else None
+
+    model_paths = [os.path.join(model_dir, model_file) for model_file in model_files]
+    model_kwargs = dict(input_size=input_size, model_size=model_size, precision=args.precision, upsample=args.upsample)
+    pipeline_kwargs = dict(
+        batch_size=batch_size,
+        read_threads=max(1, args.read_threads),
+        write_threads=max(1, args.write_threads),
+        queue_depth=args.queue_depth,
+        tile_overlap=args.tile_overlap if args.tiled else None,
+        tile_batch_size=max(1, args.tile_batch_size),
+    )
+    cache_options = dict(cache_dir=args.cache_dir, max_bytes=int(args.cache_size * 1024 ** 3)) if args.cache_dir else None
+
+    if not args.watch:
+        file_list = os.listdir(input_dir)
+        assert len(file_list) > 0, "输入目录中未找到任何图片"
+        tasks, jobs = build_tasks(file_list, input_dir, output_dir, model_paths, input_size, done_outputs)
+        manifest.add(jobs)
+        if args.workers > 1 and args.trace:
+            print('计时模式只使用一个推理进程，忽略 --workers')
+        elif args.workers > 1:
+            manifest.close()
+            run_workers(model_paths, tasks, args.workers, model_kwargs, pipeline_kwargs, cache_options, manifest_path)
+            return
+    elif args.workers > 1:
+        print('监视模式只使用一个推理进程，忽略 --workers')
+
+    colorizers = []
+    for model_file, model_path in zip(model_files, model_paths):
         print(f"\n使用模型：{model_file}")
-        colorizer = ImageColorizationPipeline(model_path=model_path, input_size=input_size, model_size=model_size)
-
-        for file_name in tqdm(file_list, desc=f"正在处理：{model_file}"):
-            img_path = os.path.join(input_dir, file_name)
-            output_name = os.path.splitext(file_name)[0] + f"_{os.path.splitext(model_file)[0]}_{input_size}.png"
-            output_path = os.path.join(output_dir, output_name)
-
-            if os.path.exists(output_path):
-                print(f"跳过 {file_name}，输出文件已存在")
-                continue
-
-            img = cv2.imread(img_path)
-            if img is not None:
-                image_out = colorizer.process(img)
-                cv2.imwrite(output_path, image_out)
-            else:
-                print(f"读取失败：{img_path}")
+        colorizers.append(ImageColorizationPipeline(model_path=model_path, **model_kwargs))
+    cache = make_cache(cache_options)
+    tracer = StageTracer(args.trace) if args.trace else None
+    if tracer is not None:
+        for colorizer in colorizers:
+            colorizer.set_tracer(tracer)
+
+    if args.watch:
+        # The models stay loaded, new pages are colorized as soon as they stop changing
+        print(f'正在监视 {input_dir}，按 Ctrl+C 退出')
+        try:
+            for file_names, changed in watch_folder(input_dir, args.watch_interval):
+                # Pages replaced while watching are colorized again over their old outputs
+                tasks, jobs = build_tasks(file_names, input_dir, output_dir, model_paths, input_size, done_outputs,
+                                          force=changed)
+                manifest.add(jobs)
+                total = sum(output_path is not None for _, output_paths in tasks for output_path in output_paths)
+                with tqdm(total=total, desc='正在处理') as pbar:
+                    run_pipeline(colorizers, tasks, cache=cache, manifest=manifest, tracer=tracer, pbar=pbar,
+                                 **pipeline_kwargs)
+        except KeyboardInterrupt:
+            pass
+    else:
+        total = sum(output_path is not None for _, output_paths in tasks for output_path in output_paths)
+        with tqdm(total=total, desc='正在处理') as pbar:
+            run_pipeline(colorizers, tasks, cache=cache, manifest=manifest, tracer=tracer, pbar=pbar,
+                         **pipeline_kwargs)
+    manifest.close()
+    if tracer is not None:
+        tracer.close()
 
 if __name__ == '__main__':
+    mp.freeze_support()
     main()
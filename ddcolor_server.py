@@ -0,0 +1,228 @@
+import json
+import asyncio
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from ddcolor_infer import ImageColorizationPipeline, PRECISIONS, UPSAMPLE_MODES
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+MAX_BODY_SIZE = 64 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=''):
+        super().__init__(message)
+        self.status = status
+
+
+class ColorizationServer:
+    """Minimal HTTP/1.1 service that keeps one colorizer warm and batches concurrent requests.
+
+    ``POST /colorize`` takes an encoded image as the request body and answers with the
+    colorized PNG. Pages are decoded and preprocessed in a thread pool and queued; a single
+    batcher waits for the first queued page, collects more until ``max_batch_size`` pages
+    are in the batch or ``max_wait`` seconds passed, and runs one forward pass for all of
+    them on a dedicated inference thread, so the event loop keeps accepting requests while
+    the model runs. ``GET /metrics`` reports the queue depth and the batch-size histogram.
+    """
+
+    def __init__(self, colorizer, max_batch_size=8, max_wait=0.01, max_queue=64, io_threads=4):
+        self.colorizer = colorizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.inference = ThreadPoolExecutor(1)
+        self.io = ThreadPoolExecutor(io_threads)
+        self.queue = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.batch_sizes = Counter()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        self.queue = asyncio.Queue(self.max_queue)
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'服务已启动：http://{host}:{port}，POST /colorize 上色，GET /metrics 查看状态')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes[len(batch)] += 1
+
+            try:
+                output_ab = await loop.run_in_executor(self.inference, self.colorizer.infer, [t for t, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), ab in zip(batch, output_ab):
+                if not future.done():  # the client may have disconnected
+                    future.set_result(ab.unsqueeze(0))
+
+    async def colorize(self, body):
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(self.io, self._prepare, body)
+        if prepared is None:
+            raise HTTPError(400, '无法解码图片')
+        orig_l, tensor = prepared
+
+        future = loop.create_future()
+        try:
+            self.queue.put_nowait((tensor, future))
+        except asyncio.QueueFull:
+            raise HTTPError(503, '请求过多，请稍后重试')
+        output_ab = await future
+        return await loop.run_in_executor(self.io, self._finish, orig_l, output_ab)
+
+    def _prepare(self, body):
+        img = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        return self.colorizer.preprocess(img) if img is not None else None
+
+    def _finish(self, orig_l, output_ab):
+        ok, data = cv2.imencode('.png', self.colorizer.postprocess(orig_l, output_ab))
+        if not ok:
+            raise RuntimeError('PNG 编码失败')
+        return data
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': sum(self.batch_sizes.values()),
+            'batch_size_histogram': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+        }
+
+    async def route(self, method, path, body):
+        if path == '/colorize':
+            if method != 'POST':
+                raise HTTPError(405)
+            self.requests += 1
+            self.in_flight += 1
+            try:
+                return 'image/png', await self.colorize(body)
+            finally:
+                self.in_flight -= 1
+        if path == '/metrics':
+            return 'application/json', json.dumps(self.metrics()).encode()
+        if path == '/health':
+            return 'text/plain', b'ok'
+        raise HTTPError(404)
+
+    async def handle(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, 'text/plain', b'', keep_alive=False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                try:
+                    if 'transfer-encoding' in headers:
+                        # The chunked body is not read, so the connection cannot be reused
+                        keep_alive = False
+                        raise HTTPError(411)
+                    try:
+                        length = int(headers.get('content-length', 0))
+                    except ValueError:
+                        length = -1
+                    if length < 0:
+                        keep_alive = False
+                        raise HTTPError(400, 'Content-Length 无效')
+                    if length > MAX_BODY_SIZE:
+                        keep_alive = False
+                        raise HTTPError(413)
+                    body = await reader.readexactly(length)
+                    content_type, payload = await self.route(method, target.split('?')[0], body)
+                    status = 200
+                except HTTPError as e:
+                    status, content_type, payload = e.status, 'text/plain; charset=utf-8', str(e).encode()
+                except Exception as e:
+                    self.errors += 1
+                    status, content_type, payload = 500, 'text/plain; charset=utf-8', str(e).encode()
+                await self.respond(writer, status, content_type, payload, keep_alive)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, content_type, payload, keep_alive=True):
+        writer.write((f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                      f'Content-Type: {content_type}\r\n'
+                      f'Content-Length: {len(payload)}\r\n'
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1'))
+        # Stream the body so large pages do not sit in the transport buffer at once
+        payload = memoryview(payload).cast('B')
+        for offset in range(0, len(payload), CHUNK_SIZE):
+            writer.write(payload[offset:offset + CHUNK_SIZE])
+            await writer.drain()
+        await writer.drain()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DDColor 本地上色服务')
+    parser.add_argument('model_path', help='.pth 检查点、固化的 .pt 或 .onnx 模型')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址，默认只接受本机请求')
+    parser.add_argument('--port', type=int, default=8000, help='监听端口')
+    parser.add_argument('--input-size', type=int, default=256, help='模型输入尺寸')
+    parser.add_argument('--model-size', default='large', choices=['tiny', 'large'], help='模型大小')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='推理精度')
+    parser.add_argument('--upsample', default='nearest', choices=UPSAMPLE_MODES, help='ab 通道上采样方式')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='动态批处理的最大批大小')
+    parser.add_argument('--max-wait-ms', type=float, default=10, help='凑批时等待后续请求的最长时间（毫秒）')
+    parser.add_argument('--max-queue', type=int, default=64, help='最多排队的请求数，超出时返回 503')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    colorizer = ImageColorizationPipeline(args.model_path, input_size=args.input_size, model_size=args.model_size,
+                                          precision=args.precision, upsample=args.upsample)
+    # Warm up so the first request does not pay for lazy initialization
+    colorizer.process(np.zeros((args.input_size, args.input_size, 3), np.uint8))
+
+    server = ColorizationServer(colorizer, max_batch_size=max(1, args.max_batch_size),
+                                max_wait=args.max_wait_ms / 1000, max_queue=args.max_queue)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()